@@ -0,0 +1,196 @@
+"""Benchmarks for the simulation kernels in main.py.
+
+Run with `python benchmark.py` from anywhere; no window is opened.
+"""
+
+import os
+import sys
+import time
+
+# Headless pygame, and the asset paths in main.py are relative to the repository
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+os.environ.setdefault('SDL_AUDIODRIVER', 'dummy')
+os.chdir(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.getcwd())
+
+import numpy as np
+
+import main as sim
+
+BENCH_SIZES = [3, 64, 256]  # Number of bodies per ensemble
+BENCH_SECONDS = 0.5  # Minimum wall time per throughput measurement
+ACCURACY_STEPS = 20  # Steps used to compare a mode against the longdouble reference (short: the larger systems are chaotic)
+TRAIL_BENCH_BODIES = [3, 64, 512]  # Bodies with full trails of max_trail_length points
+LOD_BENCH_FRAMES = 30000  # Frames of the default system recorded into level-of-detail trails
+
+
+def random_bodies(n, seed=0):
+    """Returns n bodies with random masses, positions and velocities (reproducible by seed)."""
+    if n == 3:
+        return sim.default_bodies()
+    rng = np.random.default_rng(seed)
+    return [
+        {'mass': rng.uniform(0.01, 0.1), 'pos': rng.uniform(-20, 20, 2), 'vel': rng.uniform(-0.2, 0.2, 2), 'color': (255, 255, 255)}
+        for _ in range(n)
+    ]
+
+
+def make_state(mode, n):
+    """Builds a packed state of n bodies in the given precision mode."""
+    sim.set_precision(mode)
+    return sim.pack_bodies(random_bodies(n))
+
+
+def bench_throughput(mode, n):
+    """Returns physics steps per second for n bodies in the given precision mode."""
+    state = make_state(mode, n)
+    steps = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < BENCH_SECONDS:
+        for _ in range(20):
+            sim.update_positions(state, sim.dt)
+        steps += 20
+    return steps / (time.perf_counter() - start)
+
+
+def bench_accuracy(mode, n, reference):
+    """Returns the largest position error and the relative energy error after ACCURACY_STEPS steps.
+
+    Both are measured against the longdouble reference state after the same
+    steps, so they show the rounding of the mode rather than the error of the
+    integrator, which all modes share.
+    """
+    state = make_state(mode, n)
+    for _ in range(ACCURACY_STEPS):
+        sim.update_positions(state, sim.dt)
+    pos_error = np.max(np.abs(state['pos'].astype(np.longdouble) - reference['pos']))
+    energy_error = abs(np.longdouble(sim.total_energy(state)) - reference['energy']) / abs(reference['energy'])
+    return float(pos_error), float(energy_error)
+
+
+def run_precision_benchmarks():
+    retries, sim.max_step_retries = sim.max_step_retries, 0  # Measures the kernels alone; float32 would otherwise retry more often
+    print(f"Precision modes: throughput (speedup over float64) and error after {ACCURACY_STEPS} steps")
+    print(f"{'mode':>10} {'bodies':>7} {'state bytes':>12} {'steps/s':>10} {'speedup':>8} {'max pos error':>14} {'energy error':>13}")
+    for n in BENCH_SIZES:
+        reference_state = make_state('longdouble', n)
+        for _ in range(ACCURACY_STEPS):
+            sim.update_positions(reference_state, sim.dt)
+        reference = {'pos': reference_state['pos'].copy(), 'energy': sim.total_energy(reference_state)}
+
+        rates = {mode: bench_throughput(mode, n) for mode in sim.PRECISION_MODES}
+        for mode, rate in rates.items():
+            state_bytes = sum(array.nbytes for array in make_state(mode, n).values())
+            pos_error, energy_error = bench_accuracy(mode, n, reference)
+            print(f"{mode:>10} {n:>7} {state_bytes:>12} {rate:>10.0f} {rate / rates['float64']:>7.2f}x {pos_error:>14.3e} {energy_error:>13.3e}")
+    sim.set_precision('float64')
+    sim.max_step_retries = retries
+
+
+def time_call(function, *args):
+    """Returns the average milliseconds per call of function(*args) over BENCH_SECONDS."""
+    calls = 0
+    start = time.perf_counter()
+    while time.perf_counter() - start < BENCH_SECONDS:
+        function(*args)
+        calls += 1
+    return (time.perf_counter() - start) / calls * 1000
+
+
+def fill_trails(n, length):
+    """Replaces the simulator's bodies and trails with n random walks of the given length."""
+    rng = np.random.default_rng(0)
+    sim.bodies = [{'mass': 1.0, 'color': tuple(rng.integers(64, 256, 3).tolist())} for _ in range(n)]
+    sim.trails = sim.TrailBuffer(n, length)
+    walk = np.cumsum(rng.integers(-2, 3, (length, n, 2)), axis=0) / sim.SCALE  # Pixel steps in world units
+    for points in walk:
+        sim.trails.append(points)
+
+
+def run_trail_benchmarks():
+    import pygame
+    screen = pygame.display.set_mode((sim.WIDTH, sim.HEIGHT))
+    print("Trail renderers: milliseconds per frame (including the world to screen transform)")
+    modes = [mode for mode in sim.TRAIL_MODES if mode != 'fade']  # 'fade' cost does not depend on trail length
+    print(f"{'trail pts':>9} {'transform':>9} " + " ".join(f"{mode:>9}" for mode in modes))
+    for n in TRAIL_BENCH_BODIES:
+        fill_trails(n, sim.max_trail_length)
+        row = [f"{time_call(sim.project_trails):>9.2f}"]
+        for mode in modes:
+            if mode == 'points' and n > 3:
+                row.append(f"{'-':>9}")  # Far too slow to be interesting
+                continue
+            row.append(f"{time_call(sim.TRAIL_RENDERERS[mode], screen):>9.2f}")
+        print(f"{n * sim.max_trail_length:>9} " + " ".join(row))
+
+
+def run_trail_lod_benchmark():
+    """Records the default system and compares plain and level-of-detail trails of the same memory."""
+    sim.reset_simulation()
+    plain = sim.TrailBuffer(len(sim.bodies), sim.trail_capacity(len(sim.bodies)), min_distance=sim.trail_resolution / sim.SCALE)
+    lod = sim.make_trails(len(sim.bodies))
+    start = time.perf_counter()
+    for _ in range(LOD_BENCH_FRAMES):
+        sim.update_positions(sim.state, sim.dt)
+        plain.append(sim.state['pos'])
+        lod.append(sim.state['pos'])
+    elapsed = time.perf_counter() - start
+    print(f"Trail level of detail after {LOD_BENCH_FRAMES} frames ({elapsed / LOD_BENCH_FRAMES * 1e6:.0f} us/frame incl. physics)")
+    print(f"{'trails':>8} {'bytes':>8} {'points drawn per body':>22} {'archive full':>13}")
+    print(f"{'plain':>8} {plain.nbytes:>8} {str([len(plain.view(i)) for i in range(len(plain))]):>22} {'-':>13}")
+    archive_fill = lod.archive.count.max() / lod.archive.capacity
+    print(f"{'lod':>8} {lod.nbytes:>8} {str([len(lod.view(i)) for i in range(len(lod))]):>22} {archive_fill:>12.0%}")
+    print(f"  plain keeps the newest {plain.capacity} points; lod keeps all {LOD_BENCH_FRAMES} frames while the archive is not full")
+
+
+def draw_unconverted_background(screen, image):
+    """The original background drawing: a clear and three blits of the unconverted image."""
+    screen.fill((0, 0, 0))
+    for offset in [(0, 0), (sim.WIDTH, sim.HEIGHT), (sim.WIDTH, 0)]:
+        screen.blit(image, offset)
+
+
+def run_background_benchmark():
+    import pygame
+    screen = pygame.display.set_mode((sim.WIDTH, sim.HEIGHT))
+    image = pygame.transform.scale(sim.BACKGROUND_IMAGE, (sim.WIDTH, sim.WIDTH * sim.image_scale))  # As main.py used to scale it
+    sim.build_background(screen.get_size())
+    print("Background: milliseconds per frame")
+    print(f"  unconverted, cleared: {time_call(draw_unconverted_background, screen, image):.2f}")
+    print(f"  converted tile:       {time_call(sim.draw_background, screen):.2f}")
+
+
+SPRITE_BENCH_BODIES = 500
+
+
+def run_sprite_benchmark():
+    import pygame
+    screen = pygame.display.set_mode((sim.WIDTH, sim.HEIGHT))
+    rng = np.random.default_rng(0)
+    positions = rng.integers(0, [sim.WIDTH, sim.HEIGHT], (SPRITE_BENCH_BODIES, 2)).tolist()
+    colors = [tuple(color) for color in rng.integers(64, 256, (8, 3)).tolist()]
+    radii = rng.integers(2, 12, SPRITE_BENCH_BODIES).tolist()
+
+    def draw_circles():
+        for (x, y), radius, k in zip(positions, radii, range(SPRITE_BENCH_BODIES)):
+            pygame.draw.circle(screen, colors[k % 8], (x, y), radius)
+            pygame.draw.circle(screen, colors[k % 8], (x, y), radius, 1)
+
+    def draw_sprites(glow):
+        sim.body_glow = glow
+        for (x, y), radius, k in zip(positions, radii, range(SPRITE_BENCH_BODIES)):
+            sim.draw_body(screen, colors[k % 8], (x, y), radius)
+
+    print(f"Bodies: milliseconds per frame for {SPRITE_BENCH_BODIES} bodies")
+    print(f"  two circles:        {time_call(draw_circles):.2f}")
+    print(f"  sprites:            {time_call(draw_sprites, False):.2f}")
+    print(f"  sprites with glow:  {time_call(draw_sprites, True):.2f}")
+    sim.body_glow = False
+
+
+if __name__ == "__main__":
+    run_precision_benchmarks()
+    run_trail_benchmarks()
+    run_trail_lod_benchmark()
+    run_background_benchmark()
+    run_sprite_benchmark()
@@ -9,14 +9,38 @@
 import pygame
 import numpy as np
 import asyncio
+import argparse
+import cProfile
+import functools
+import json
+import math
+import os
+import queue
+import sys
+import threading
+import time
+import tracemalloc
+import weakref
+from collections import Counter, deque
+from contextlib import contextmanager
 
 # Constants
 G = 1  # Gravitational constant (normalized for simplicity)
 dt = 0.01  # Time step for numerical integration
+DEFAULT_G, DEFAULT_DT = G, dt  # Restored by reset_simulation() after the sliders changed them
 num_steps = 1000  # Number of simulation steps
 WIDTH, HEIGHT = 1200, 800  # Screen dimensions
 SCALE = 100  # Scaling factor to visualize position values in pixels
 
+# Numeric precision of the simulation state, chosen once for all arrays and kernels
+PRECISION_MODES = {
+    'float32': np.float32,  # half the memory and bandwidth, for large ensembles
+    'float64': np.float64,  # default
+    'longdouble': np.longdouble,  # extended precision for archival runs
+}
+precision = 'float64'
+DTYPE = PRECISION_MODES[precision]
+
 # UI Controls
 paused = False
 display_info = False
@@ -27,16 +51,280 @@ button_font = None
 pygame.init()
 BACKGROUND_IMAGE = pygame.image.load("assets/background/space.png")
 BACKGROUND_WIDTH, BACKGROUND_HEIGHT = BACKGROUND_IMAGE.get_size()
-pygame.RESIZABLE   
 image_scale = BACKGROUND_IMAGE.get_height()/BACKGROUND_IMAGE.get_width() #save scale of image height and width
-BACKGROUND_IMAGE = pygame.transform.scale(BACKGROUND_IMAGE, (WIDTH, WIDTH*image_scale)) #scale image to its original proportion according to width
 bg_x, bg_y = 0, 0
 bg_x_speed, bg_y_speed = 0.05, 0.2 
+background_tile = None  # Display-format copy of the image, tiled for wrap-around scrolling (see build_background)
+background_size = (0, 0)  # Size of the scaled image repeated in the tile
+
+@functools.lru_cache(maxsize=4)
+def background_for(size):
+    """Returns the scaled image size and the background tile for a screen of the given size.
+
+    The image is scaled to the screen width in its original proportion and
+    converted to the display pixel format. The tile repeats it so that any
+    scroll offset is covered by at most two blits. Converting drops any alpha,
+    so the background is opaque and the screen does not need to be cleared
+    under it. The few most recent sizes are kept, so toggling fullscreen or
+    resizing back and forth does not scale the image again.
+    """
+    width, height = size
+    image = pygame.transform.scale(BACKGROUND_IMAGE, (width, int(width * image_scale))).convert()
+    image_width, image_height = image.get_size()
+    tile = pygame.Surface((image_width * math.ceil(width / image_width), image_height + height)).convert()
+    for x in range(0, tile.get_width(), image_width):
+        for y in range(0, tile.get_height(), image_height):
+            tile.blit(image, (x, y))
+    cached_surfaces['background'].update((image, tile))
+    return image.get_size(), tile
+
+def build_background(size):
+    """Selects the background tile for a screen of the given size."""
+    global background_tile, background_size
+    background_size, background_tile = background_for(tuple(size))
+
+def draw_background(screen, scroll=True):
+    """Draws the scrolling background and advances the scroll (unless scroll is False)."""
+    global bg_x, bg_y
+    if background_tile is None:
+        screen.fill((0,0,0))
+        return
+    image_width, image_height = background_size
+    width, height = screen.get_size()
+    x, y = int(-bg_x) % image_width, int(-bg_y) % image_height  # Offset into the repeating image
+    first = min(background_tile.get_width() - x, width)
+    screen.blit(background_tile, (0, 0), pygame.Rect(x, y, first, height))
+    if first < width:  # Wraps around horizontally
+        screen.blit(background_tile, (first, 0), pygame.Rect(0, y, width - first, height))
+    if scroll:
+        bg_x = (bg_x - bg_x_speed) % -image_width  # x changes in negative direction: to the left
+        bg_y = (bg_y - bg_y_speed) % -image_height
+
+# Frame timing: time spent in each phase of the frame loop, reported on exit
+frame_phase_ns = Counter()  # Total nanoseconds per phase
+timed_frames = 0
+phase_start_ns = 0
+frame_start_ns = 0
+frame_times_ns = deque(maxlen=600)  # Durations of the most recent frames, from one frame start to the next
+frame_phases_ns = {}  # Nanoseconds of every phase of the current frame
+RENDER_PHASES = ('background', 'trails', 'bodies', 'ui', 'flip')
+dropped_frames = 0  # Frames that took more than 1.5 frame intervals
+
+class Histogram:
+    """Counts durations in log-linear buckets, like an HDR histogram.
+
+    Values (in microseconds) below 2 * 2**sub_bits have a bucket of their own;
+    above that every power of two is split into 2**sub_bits buckets, so any
+    percentile is exact to about 1 / 2**sub_bits of its value at every
+    magnitude, in a few hundred buckets at most.
+    """
+
+    def __init__(self, sub_bits=6):
+        self.sub_bits = sub_bits
+        self.buckets = Counter()
+        self.count = 0
+        self.total = 0
+        self.max = 0
+
+    def record(self, ns):
+        value = ns // 1000
+        shift = max(0, value.bit_length() - self.sub_bits - 1)
+        self.buckets[(shift << self.sub_bits) + (value >> shift)] += 1
+        self.count += 1
+        self.total += value
+        self.max = max(self.max, value)
+
+    def bucket_value(self, index):
+        """Returns the upper end (in microseconds) of the values counted in a bucket."""
+        shift = max(0, (index >> self.sub_bits) - 1)
+        return ((index - (shift << self.sub_bits) + 1) << shift) - 1
+
+    def percentile(self, p):
+        """Returns the p-th percentile in microseconds (at most one bucket too high)."""
+        rank = p / 100 * self.count
+        seen = 0
+        for index in sorted(self.buckets):
+            seen += self.buckets[index]
+            if seen >= rank:
+                return min(self.bucket_value(index), self.max)
+        return self.max
+
+    def summary(self):
+        """Returns count, mean, p50/p90/p99 and max in milliseconds."""
+        if not self.count:
+            return {'count': 0}
+        summary = {'count': self.count, 'mean': self.total / self.count / 1000}
+        for p in (50, 90, 99):
+            summary[f'p{p}'] = self.percentile(p) / 1000
+        summary['max'] = self.max / 1000
+        return summary
+
+histograms = {'frame': Histogram(), 'step': Histogram(), 'render': Histogram()}
+histogram_path = None  # JSON file written on exit and with H (--histograms)
+
+def start_frame_timing():
+    """Starts timing the phases of a new frame."""
+    global timed_frames, phase_start_ns, frame_start_ns, dropped_frames
+    timed_frames += 1
+    now = time.perf_counter_ns()
+    if frame_start_ns:
+        duration = now - frame_start_ns
+        frame_times_ns.append(duration)
+        histograms['frame'].record(duration)
+        if duration > 1.5e9 / frame_rate():
+            dropped_frames += 1
+        if trace_writer is not None:
+            trace_writer.complete('frame', 'frame', frame_start_ns, now)
+    if frame_phases_ns:
+        histograms['render'].record(sum(frame_phases_ns.get(name, 0) for name in RENDER_PHASES))
+        frame_phases_ns.clear()
+    phase_start_ns = frame_start_ns = now
+
+def suspend_frame_timing():
+    """Keeps the time until the next frame (an idle wait) out of the frame times."""
+    global frame_start_ns
+    frame_start_ns = 0
+
+def end_phase(name):
+    """Adds the time since the previous phase ended to phase `name`."""
+    global phase_start_ns
+    now = time.perf_counter_ns()
+    frame_phase_ns[name] += now - phase_start_ns
+    frame_phases_ns[name] = now - phase_start_ns
+    if trace_writer is not None:
+        trace_writer.complete(name, 'phase', phase_start_ns, now)
+    phase_start_ns = now
+
+def print_frame_timing_report():
+    """Prints the average milliseconds per frame of every phase."""
+    if timed_frames:
+        phases = ' | '.join(f"{name} {total / timed_frames / 1e6:.2f}" for name, total in frame_phase_ns.items())
+        print(f"Frame timing over {timed_frames} frames (ms per frame): {phases}")
+
+def histogram_report():
+    """Returns the percentiles of every histogram and the dropped frames, as a JSON-ready dict."""
+    report = {name: histogram.summary() for name, histogram in histograms.items()}
+    report['dropped_frames'] = dropped_frames
+    return report
+
+def print_histogram_report():
+    """Prints the histogram percentiles, and writes them to histogram_path if set."""
+    report = histogram_report()
+    for name, histogram in histograms.items():
+        summary = report[name]
+        if summary['count']:
+            print(f"{name:>6} time (ms, {summary['count']} samples): p50 {summary['p50']:.2f} | p90 {summary['p90']:.2f} | "
+                  f"p99 {summary['p99']:.2f} | max {summary['max']:.2f}")
+    print(f"Dropped frames: {dropped_frames}")
+    if histogram_path:
+        with open(histogram_path, 'w') as file:
+            json.dump(report, file, indent=2)
+        print(f"Histograms written to {histogram_path}")
+
+# Trace events (--trace FILE, or T to start and stop): Chrome/Perfetto trace-event JSON of frames, phases and steps
+trace_writer = None  # The active TraceWriter
+
+class TraceWriter:
+    """Streams trace events to a JSON file; open it in ui.perfetto.dev or chrome://tracing.
+
+    Events are queued and written by a background thread, so the traced code
+    only pays for building a tuple. The web build has no threads and writes
+    directly.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, 'w')
+        self.file.write('[\n')
+        self.first = True
+        self.pid = os.getpid()
+        self.queue = queue.SimpleQueue()
+        self.thread = None
+        if sys.platform != 'emscripten':
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def complete(self, name, category, start_ns, end_ns):
+        """Records a span from start_ns to end_ns (perf_counter_ns) of the calling thread."""
+        self.put(('X', name, category, start_ns, end_ns, threading.get_ident()))
+
+    def instant(self, name, category):
+        """Records a point in time, such as a rejected step."""
+        self.put(('i', name, category, time.perf_counter_ns(), None, threading.get_ident()))
+
+    def put(self, event):
+        if self.thread is None:
+            self.write(event)
+        else:
+            self.queue.put(event)
+
+    def write(self, event):
+        phase, name, category, start_ns, end_ns, thread = event
+        record = {'name': name, 'cat': category, 'ph': phase, 'ts': start_ns / 1000, 'pid': self.pid, 'tid': thread}
+        if phase == 'X':
+            record['dur'] = (end_ns - start_ns) / 1000
+        else:
+            record['s'] = 't'  # Instant event scoped to its thread
+        self.file.write(('' if self.first else ',\n') + json.dumps(record))
+        self.first = False
+
+    def run(self):
+        while (event := self.queue.get()) is not None:
+            self.write(event)
 
+    def close(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+        self.file.write('\n]\n')
+        self.file.close()
+        print(f"Trace written to {self.path}")
 
+def start_trace(path=None):
+    global trace_writer
+    if trace_writer is None:
+        trace_writer = TraceWriter(path or time.strftime("trace-%Y%m%d-%H%M%S.json"))
 
+def stop_trace():
+    global trace_writer
+    if trace_writer is not None:
+        trace_writer, writer = None, trace_writer
+        writer.close()
 
+def toggle_trace():
+    if trace_writer is None:
+        start_trace()
+    else:
+        stop_trace()
 
+@contextmanager
+def trace_span(name, category='app'):
+    """Context manager that records the enclosed code as a span while tracing."""
+    if trace_writer is None:
+        yield
+        return
+    start = time.perf_counter_ns()
+    try:
+        yield
+    finally:
+        if trace_writer is not None:
+            trace_writer.complete(name, category, start, time.perf_counter_ns())
+
+def traced(name, category='app'):
+    """Decorator that records every call of the function as a span while tracing."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if trace_writer is None:
+                return function(*args, **kwargs)
+            start = time.perf_counter_ns()
+            try:
+                return function(*args, **kwargs)
+            finally:
+                if trace_writer is not None:
+                    trace_writer.complete(name, category, start, time.perf_counter_ns())
+        return wrapper
+    return decorate
 
 # Load and Play Background Music
 pygame.mixer.init()
@@ -46,60 +334,443 @@ pygame.mixer.music.set_volume(.5)
 
 # Cut off max speed of bodies
 max_body_speed = 8
+elapsed_time = 0  # Simulation time in days
+
+# Velocity limiter bookkeeping: counters and a bounded event log instead of printing on the hot path
+speed_clamp_counts = Counter()  # Clamp events per body index
+speed_clamp_log = deque(maxlen=256)  # Most recent (elapsed_time, body index, speed before clamping)
 
 # Default Initial Conditions - Slightly Unstable System
 def default_bodies():
     return [
-        {'mass': 1.0, 'pos': np.array([-1.02, 0.25]), 'vel': np.array([0.47, 0.42]), 'color': (255, 0, 0)},
-        {'mass': .4, 'pos': np.array([2.01, -0.24]), 'vel': np.array([-0.8, .85]), 'color': (0, 255, 0)},
-        {'mass': 2.0, 'pos': np.array([0.0, 0.0]), 'vel': np.array([-0.92, -0.97]), 'color': (0, 0, 255)}
+        {'mass': 1.0, 'pos': np.array([-1.02, 0.25], dtype=DTYPE), 'vel': np.array([0.47, 0.42], dtype=DTYPE), 'color': (255, 0, 0)},
+        {'mass': .4, 'pos': np.array([2.01, -0.24], dtype=DTYPE), 'vel': np.array([-0.8, .85], dtype=DTYPE), 'color': (0, 255, 0)},
+        {'mass': 2.0, 'pos': np.array([0.0, 0.0], dtype=DTYPE), 'vel': np.array([-0.92, -0.97], dtype=DTYPE), 'color': (0, 0, 255)}
     ]
 
+def pack_bodies(bodies):
+    """Packs masses, positions and velocities into contiguous arrays of the current precision.
+
+    Each body's 'pos' and 'vel' become views into the shared (N, 2) arrays, so the
+    drawing code can keep reading body['pos'] while the kernels work on whole arrays.
+    """
+    state = {
+        'mass': np.array([body['mass'] for body in bodies], dtype=DTYPE),
+        'pos': np.array([body['pos'] for body in bodies], dtype=DTYPE).reshape(-1, 2),
+        'vel': np.array([body['vel'] for body in bodies], dtype=DTYPE).reshape(-1, 2),
+    }
+    for i, body in enumerate(bodies):
+        body['pos'] = state['pos'][i]
+        body['vel'] = state['vel'][i]
+    return state
+
+# Velocity of the center of mass removed by normalize_frame(), added back for world-frame readouts
+barycenter = {'vel': np.zeros(2)}
+
+def normalize_frame(state):
+    """Moves the state into the barycentric frame: center of mass at the origin, zero total momentum.
+
+    Called after loading or editing the bodies. The removed velocity is added to
+    `barycenter`, so world-frame speeds are known without a per-frame reduction.
+    """
+    total_mass = state['mass'].sum()
+    com_pos = state['mass'] @ state['pos'] / total_mass
+    com_vel = state['mass'] @ state['vel'] / total_mass
+    state['pos'] -= com_pos
+    state['vel'] -= com_vel
+    barycenter['vel'] += com_vel
+
+def load_bodies(bodies):
+    """Packs the bodies into a new state in the barycentric frame."""
+    barycenter['vel'][:] = 0
+    state = pack_bodies(bodies)
+    normalize_frame(state)
+    return state
+
 bodies = default_bodies()
-trails = [[] for _ in bodies]  # Restore trails
+state = load_bodies(bodies)
 max_trail_length = 3000  # Controls how long the trails remain visible
+trail_memory_budget = 256 * 1024  # Bytes shared by the trails of all bodies
+
+trail_resolution = 1.0  # Pixels (at SCALE) a body has to move before a new trail point is stored
+
+# Level of detail: only the newest points of a trail are kept at full resolution, older
+# ones are thinned to what can be seen, so the same memory holds a much longer history
+trail_lod = True
+trail_lod_recent = 600  # Newest points per body kept at full resolution
+trail_lod_tolerance = 1.0  # Pixels (at SCALE) an older point may be off the thinned trail
+
+class TrailBuffer:
+    """Fixed-capacity circular buffers of trail points for all bodies, in one array.
+
+    Every point is written twice, at slot k and k + capacity, so the ordered history
+    of a body is always the contiguous slice data[i, start:start + count]: appending
+    is O(1) and reading a trail never copies. Points closer than `min_distance` to
+    the newest point of their body are not stored.
+    """
+
+    def __init__(self, num_bodies, capacity, dtype=np.float32, min_distance=0.0):
+        self.capacity = capacity
+        self.min_distance = min_distance
+        self.data = np.zeros((num_bodies, 2 * capacity, 2), dtype=dtype)
+        self.start = np.zeros(num_bodies, dtype=np.intp)  # Slot of the oldest point
+        self.count = np.zeros(num_bodies, dtype=np.intp)
+
+    def __len__(self):
+        return len(self.count)
+
+    def append(self, points, rows=None):
+        """Appends one point per body (or per body in `rows`); bodies that have not moved are skipped.
+
+        Returns the bodies whose oldest point was overwritten, and those points.
+        """
+        points = np.asarray(points, dtype=self.data.dtype)
+        rows = np.arange(len(self.count)) if rows is None else np.asarray(rows, dtype=np.intp)
+        newest = self.data[rows, (self.start[rows] + self.count[rows] - 1) % self.capacity]
+        step = newest - points
+        moved = (self.count[rows] == 0) | (np.einsum('ij,ij->i', step, step) > self.min_distance ** 2)
+        rows, points = rows[moved], points[moved]
+        slot = (self.start[rows] + self.count[rows]) % self.capacity
+        full = self.count[rows] == self.capacity
+        evicted = self.data[rows[full], slot[full]]  # Copy of the oldest points about to be overwritten
+        self.data[rows, slot] = points
+        self.data[rows, slot + self.capacity] = points
+        self.start[rows[full]] = (self.start[rows[full]] + 1) % self.capacity
+        self.count[rows[~full]] += 1
+        return rows[full], evicted
+
+    def view(self, i):
+        """Returns the trail of body i, oldest point first, as a view into the buffer."""
+        return self.data[i, self.start[i]:self.start[i] + self.count[i]]
+
+    def newest(self, rows):
+        """Returns the newest point of each body in rows."""
+        return self.data[rows, self.start[rows] + self.count[rows] - 1]
+
+    def tail(self, i, k):
+        """Returns the newest (at most) k points of body i, oldest first."""
+        end = self.start[i] + self.count[i]
+        return self.data[i, max(self.start[i], end - k):end]
+
+    def clear(self):
+        self.start[:] = 0
+        self.count[:] = 0
+
+    @property
+    def nbytes(self):
+        return self.data.nbytes + self.start.nbytes + self.count.nbytes
+
+class DecimatedTrailBuffer(TrailBuffer):
+    """Trail buffer that keeps the newest points at full resolution and thins older ones.
+
+    Points pushed out of the full resolution buffer are simplified with an opening
+    window: a run of points is replaced by its last point as long as none of them
+    lies more than `tolerance` off the straight line that replaces them, and
+    at most `window` points are merged (stride-based thinning for long straight runs).
+    The thinned points are kept in an archive buffer.
+    """
+
+    def __init__(self, num_bodies, capacity, archive_capacity, tolerance, window=64, dtype=np.float32, min_distance=0.0):
+        super().__init__(num_bodies, capacity, dtype, min_distance)
+        self.archive = TrailBuffer(num_bodies, archive_capacity, dtype)
+        self.tolerance = tolerance
+        self.pending = np.zeros((num_bodies, window, 2), dtype=dtype)  # Points since the last archived one
+        self.pending_count = np.zeros(num_bodies, dtype=np.intp)
+
+    def append(self, points, rows=None):
+        rows, evicted = super().append(points, rows)
+        if len(rows):
+            self.archive_points(rows, evicted)
+        return rows, evicted
+
+    def archive_points(self, rows, points):
+        """Extends the window of each body with its evicted point, archiving where the window must close."""
+        first = self.archive.count[rows] == 0
+        if np.any(first):
+            self.archive.append(points[first], rows[first])
+            rows, points = rows[~first], points[~first]
+        if not len(rows):
+            return
+        window = self.pending.shape[1]
+        count = self.pending_count[rows]
+        anchor = self.archive.newest(rows).astype(float)  # Last archived point
+        chord = points - anchor
+        offset = self.pending[rows] - anchor[:, np.newaxis]
+        chord_length = np.hypot(chord[:, 0], chord[:, 1])[:, np.newaxis]
+        cross = np.abs(chord[:, np.newaxis, 0] * offset[..., 1] - chord[:, np.newaxis, 1] * offset[..., 0])
+        distance = np.where(chord_length > 0, cross / np.maximum(chord_length, 1e-12), np.hypot(offset[..., 0], offset[..., 1]))
+        distance[np.arange(window) >= count[:, np.newaxis]] = 0  # Unused window slots
+        close = (distance.max(axis=1) > self.tolerance) | (count == window)
+
+        # Closed windows: their last point is archived and the new point opens the next window
+        closed = rows[close]
+        self.archive.append(self.pending[closed, count[close] - 1], closed)
+        self.pending[closed, 0] = points[close]
+        self.pending_count[closed] = 1
+        extended = rows[~close]
+        self.pending[extended, count[~close]] = points[~close]
+        self.pending_count[extended] += 1
 
-def compute_accelerations(bodies):
-    """Computes gravitational acceleration for each body due to all other bodies."""
-    n = len(bodies)
-    accelerations = [np.zeros(2) for _ in range(n)]
-    for i in range(n):
-        for j in range(n):
-            if i != j:
-                r = bodies[j]['pos'] - bodies[i]['pos']  # Vector from body[i] to body[j]
-                distance = np.linalg.norm(r)  # Euclidean distance
-                if distance > 0:
-                    force = G * bodies[j]['mass'] / distance**3 * r  # Newton's law of gravity (normalized)
-                    accelerations[i] += force
+    def view(self, i):
+        """Returns the thinned and full resolution trail of body i, oldest point first (a copy)."""
+        pending = self.pending[i, self.pending_count[i] - 1:self.pending_count[i]]  # Points before it are within tolerance
+        return np.concatenate((self.archive.view(i), pending, super().view(i)))
+
+    def clear(self):
+        super().clear()
+        self.archive.clear()
+        self.pending_count[:] = 0
+
+    @property
+    def nbytes(self):
+        return super().nbytes + self.archive.nbytes + self.pending.nbytes + self.pending_count.nbytes
+
+def trail_capacity(num_bodies, bytes_per_point=16):
+    """Points per body that fit into trail_memory_budget (each point is stored twice), at most max_trail_length."""
+    return max(1, min(max_trail_length, trail_memory_budget // (num_bodies * bytes_per_point)))
+
+def make_trails(num_bodies):
+    """Returns empty trails for num_bodies, thinned by level of detail if trail_lod is set.
+
+    Trails store world coordinates; the pixel settings are converted at SCALE.
+    """
+    capacity = trail_capacity(num_bodies)
+    min_distance = trail_resolution / SCALE
+    if not trail_lod or capacity < 4:
+        return TrailBuffer(num_bodies, capacity, min_distance=min_distance)
+    recent = min(trail_lod_recent, capacity // 2)
+    return DecimatedTrailBuffer(num_bodies, recent, capacity - recent, trail_lod_tolerance / SCALE, min_distance=min_distance)
+
+trails = make_trails(len(bodies))  # Restore trails
+
+def set_precision(mode):
+    """Selects the precision ('float32', 'float64' or 'longdouble') of the whole simulation state."""
+    global precision, DTYPE, state
+    if mode not in PRECISION_MODES:
+        raise ValueError(f"Unknown precision mode {mode!r}, expected one of {', '.join(PRECISION_MODES)}")
+    precision = mode
+    DTYPE = PRECISION_MODES[mode]
+    state = pack_bodies(bodies)  # Converts the running system in place of the old arrays
+    reset_diagnostics()
+
+def compute_accelerations(pos, mass, with_potential=False):
+    """Computes gravitational acceleration for each body due to all other bodies.
+
+    All pairs are evaluated at once on the (N, 2) position array, in the precision of `pos`.
+    With `with_potential`, also returns the total potential energy from the same pass.
+    """
+    dx = pos[np.newaxis, :, 0] - pos[:, np.newaxis, 0]  # dx[i, j] = x distance from body i to body j
+    dy = pos[np.newaxis, :, 1] - pos[:, np.newaxis, 1]
+    dist2 = dx * dx + dy * dy  # Squared distances
+    dist2[dist2 == 0] = np.inf  # Skips self-interaction and coincident bodies
+    inv_dist = 1 / np.sqrt(dist2)
+    weights = (G * mass[np.newaxis, :]) * (inv_dist * inv_dist * inv_dist)  # Newton's law of gravity (normalized)
+    # Sums the differences directly; w @ pos - w.sum() * pos cancels badly away from the origin
+    accelerations = np.stack((np.einsum('ij,ij->i', weights, dx), np.einsum('ij,ij->i', weights, dy)), axis=1)
+    if with_potential:
+        potential = -0.5 * G * (mass @ inv_dist @ mass)  # Every pair is counted twice
+        return accelerations, potential
     return accelerations
 
-def update_positions(bodies, dt):
-    """Updates positions and velocities using the Euler method."""
-    accels = compute_accelerations(bodies)
-    for i, body in enumerate(bodies):
-        body['vel'] += accels[i] * dt * speed_multiplier  # Adjust simulation speed
-        
-        # Speed control
-        if body['vel'][0] > max_body_speed:
-            print(f"body {i} vel x: {body['vel'][0]}")
-            print('SPEED CONTROL')
-            body['vel'][0] = max_body_speed     
-        if body['vel'][1] > max_body_speed:
-            print(f"body {i} vel y: {body['vel'][1]}")
-            print('SPEED CONTROL')
-            body['vel'][1] = max_body_speed
-        if body['vel'][0] < -max_body_speed:
-            print(f"body {i} vel x: {body['vel'][0]}")
-            print('SPEED CONTROL')
-            body['vel'][0] = -max_body_speed
-        if body['vel'][1] < -max_body_speed:
-            print(f"body {i} vel y: {body['vel'][1]}")
-            print('SPEED CONTROL')
-            body['vel'][1] = -max_body_speed
-
-        #print(f"body {i} vel x,y:", body['vel'] ) ### Debugging
-        body['pos'] += body['vel'] * dt * speed_multiplier
-    return bodies
+def refresh_accelerations(state):
+    """Caches the accelerations and potential energy of the current positions in the state."""
+    state['acc'], state['potential'] = compute_accelerations(state['pos'], state['mass'], with_potential=True)
+
+def limit_velocities(vel):
+    """Clamps the speed of every body to max_body_speed in one vectorized operation.
+
+    The direction of motion is kept. Returns the indices of the clamped bodies.
+    """
+    speed = np.sqrt(np.einsum('ij,ij->i', vel, vel))
+    clamped = np.flatnonzero(speed > max_body_speed)
+    if clamped.size:
+        vel[clamped] *= (max_body_speed / speed[clamped])[:, np.newaxis]
+        record_speed_clamps(clamped, speed[clamped])
+    return clamped
+
+def record_speed_clamps(indices, speeds):
+    """Counts and logs clamp events; no I/O so it is safe on the hot path."""
+    for i, speed in zip(indices.tolist(), speeds.tolist()):
+        speed_clamp_counts[i] += 1
+        speed_clamp_log.append((elapsed_time, i, speed))
+
+def get_speed_clamp_stats():
+    """Returns the total and per-body clamp counts and the most recent clamp events."""
+    return {
+        'total': sum(speed_clamp_counts.values()),
+        'per_body': dict(speed_clamp_counts),
+        'recent': list(speed_clamp_log),
+    }
+
+def clear_speed_clamp_stats():
+    """Forgets all recorded clamp events."""
+    speed_clamp_counts.clear()
+    speed_clamp_log.clear()
+
+def print_speed_clamp_summary():
+    """Prints a one-line summary of the clamp events, if any happened."""
+    stats = get_speed_clamp_stats()
+    if stats['total']:
+        per_body = ', '.join(f"body {i}: {count}" for i, count in sorted(stats['per_body'].items()))
+        print(f"SPEED CONTROL clamped {stats['total']} times ({per_body})")
+
+# Step rejection: a macro-step whose energy error exceeds the tolerance is rolled back
+# and retried with twice as many substeps
+substeps = 1  # Euler substeps per macro-step (one macro-step per frame)
+energy_tolerance = 2e-3  # Relative energy error allowed in one macro-step
+max_step_retries = 4  # Retries before a step is accepted anyway (up to 16x the substeps)
+step_rejections = 0  # Rolled back macro-steps since the last reset
+euler_steps = 0  # Euler steps taken (including rolled back ones), for the performance HUD
+
+@traced('euler step', 'physics')
+def step_euler(state, h):
+    """Advances the state by one Euler substep of length h.
+
+    The accelerations of the new positions are computed at the end of the step and
+    reused by the next one, which leaves the potential energy of the current
+    positions in the state for the diagnostics at no extra cost. Returns the
+    number of bodies whose speed was clamped.
+    """
+    state['vel'] += state['acc'] * h
+    clamped = limit_velocities(state['vel']).size  # Speed control
+    if clamped:
+        normalize_frame(state)  # Clamping changes the total momentum
+    state['pos'] += state['vel'] * h
+    refresh_accelerations(state)
+    return clamped
+
+def total_energy(state):
+    """Returns kinetic plus (cached) potential energy of the state."""
+    return 0.5 * state['mass'] @ np.einsum('ij,ij->i', state['vel'], state['vel']) + state['potential']
+
+def snapshot_state(state):
+    """Returns a cheap copy of everything a step changes, for restore_state()."""
+    return {
+        'pos': state['pos'].copy(),
+        'vel': state['vel'].copy(),
+        'acc': state['acc'],  # Replaced, never modified in place, by refresh_accelerations
+        'potential': state['potential'],
+        'barycenter_vel': barycenter['vel'].copy(),
+    }
+
+def restore_state(state, snapshot):
+    """Rolls the state back to a snapshot, in place so the bodies' views stay valid."""
+    state['pos'][:] = snapshot['pos']
+    state['vel'][:] = snapshot['vel']
+    state['acc'] = snapshot['acc']
+    state['potential'] = snapshot['potential']
+    barycenter['vel'][:] = snapshot['barycenter_vel']
+
+@traced('update_positions', 'physics')
+def update_positions(state, dt):
+    """Advances the state by one macro-step of dt * speed_multiplier using the Euler method.
+
+    If the relative energy error of the macro-step exceeds energy_tolerance, the
+    step is rolled back and retried with the substep halved. A macro-step in which
+    the speed limiter acted is accepted as is: the limiter removes energy on
+    purpose and smaller substeps cannot give it back. Only accepted steps clamp,
+    so every recorded clamp event belongs to the simulation that is shown.
+    """
+    global step_rejections, euler_steps
+    step_start = time.perf_counter_ns()
+    if 'acc' not in state:
+        refresh_accelerations(state)
+    h = dt * speed_multiplier  # Adjust simulation speed
+    energy_before = total_energy(state)
+    snapshot = snapshot_state(state)
+    n = substeps
+    for attempt in range(max_step_retries + 1):
+        clamped = 0
+        for _ in range(n):
+            clamped += step_euler(state, h / n)
+        euler_steps += n
+        if clamped or attempt == max_step_retries:
+            break
+        error = abs(total_energy(state) - energy_before) / (abs(energy_before) or 1.0)
+        if error <= energy_tolerance:
+            break
+        restore_state(state, snapshot)
+        step_rejections += 1
+        if trace_writer is not None:
+            trace_writer.instant('step rejected', 'physics')
+        n *= 2
+    if diagnostics_enabled:
+        with trace_span('diagnostics', 'physics'):
+            update_diagnostics(state)
+    histograms['step'].record(time.perf_counter_ns() - step_start)
+    return state
+
+# Conserved quantity monitor (optional, see toggle_diagnostics)
+diagnostics_enabled = False
+drift_threshold = 1e-3  # Relative drift that raises the drift callbacks
+diagnostics_history = deque(maxlen=600)  # Ring buffer of {quantity: relative drift}, one entry per step
+diagnostics_baseline = None  # Quantities and drift scales at the start of the run
+drift_alarms = set()  # Quantities currently above the threshold
+drift_callbacks = []  # Called as callback(quantity, drift, quantities) when a drift crosses the threshold
+
+def conserved_quantities(state):
+    """Returns total energy, linear and angular momentum and virial ratio of the state.
+
+    Uses the potential energy cached by the last acceleration pass.
+    """
+    if 'potential' not in state:
+        refresh_accelerations(state)
+    mass, pos, vel = state['mass'], state['pos'], state['vel']
+    kinetic = 0.5 * mass @ np.einsum('ij,ij->i', vel, vel)
+    potential = state['potential']
+    return {
+        'energy': kinetic + potential,  # Same as total_energy(state)
+        'kinetic': kinetic,
+        'potential': potential,
+        'momentum': mass @ vel,
+        'angular_momentum': mass @ (pos[:, 0] * vel[:, 1] - pos[:, 1] * vel[:, 0]),
+        'virial_ratio': 2 * kinetic / abs(potential) if potential else np.inf,
+    }
+
+def update_diagnostics(state):
+    """Records the relative drift of the conserved quantities and raises the drift callbacks."""
+    global diagnostics_baseline
+    quantities = conserved_quantities(state)
+    if diagnostics_baseline is None:
+        # Momenta are compared to their typical magnitude, since both can start at zero
+        speed = np.sqrt(np.einsum('ij,ij->i', state['vel'], state['vel']))
+        radius = np.sqrt(np.einsum('ij,ij->i', state['pos'], state['pos']))
+        diagnostics_baseline = {
+            'quantities': quantities,
+            'scales': {
+                'energy': abs(quantities['energy']) or 1.0,
+                'momentum': state['mass'] @ speed or 1.0,
+                'angular_momentum': state['mass'] @ (radius * speed) or 1.0,
+            },
+        }
+    initial, scales = diagnostics_baseline['quantities'], diagnostics_baseline['scales']
+    drifts = {
+        'energy': float(abs(quantities['energy'] - initial['energy']) / scales['energy']),
+        'momentum': float(np.linalg.norm(quantities['momentum'] - initial['momentum']) / scales['momentum']),
+        'angular_momentum': float(abs(quantities['angular_momentum'] - initial['angular_momentum']) / scales['angular_momentum']),
+    }
+    diagnostics_history.append(drifts)
+    for quantity, drift in drifts.items():
+        if drift > drift_threshold and quantity not in drift_alarms:
+            drift_alarms.add(quantity)
+            for callback in drift_callbacks:
+                callback(quantity, drift, quantities)
+        elif drift <= drift_threshold:
+            drift_alarms.discard(quantity)
+    return drifts
+
+def reset_diagnostics():
+    """Restarts the drift measurement from the current state."""
+    global diagnostics_baseline
+    diagnostics_baseline = None
+    diagnostics_history.clear()
+    drift_alarms.clear()
+
+def toggle_diagnostics():
+    """Turns the conserved quantity monitor on or off."""
+    global diagnostics_enabled
+    diagnostics_enabled = not diagnostics_enabled
+    reset_diagnostics()
 
 def toggle_pause():
     """Toggles the simulation pause state."""
@@ -117,132 +788,1126 @@ def adjust_speed(factor):
     speed_multiplier += factor
     #speed_multiplier = max(0.1, min(speed_multiplier * factor, 10))  # Keep speed within reasonable bounds
 
+def set_time_step(value):
+    """Sets the time step of one frame."""
+    global dt
+    dt = value
+
+def set_gravity(value):
+    """Sets the gravitational constant; the cached accelerations and the drift baseline depend on it."""
+    global G
+    G = value
+    refresh_accelerations(state)
+    reset_diagnostics()
+
+def set_trail_length(value):
+    """Sets max_trail_length and starts new trails of that length."""
+    global max_trail_length, trails
+    max_trail_length = int(value)
+    trails = make_trails(len(bodies))
+    clear_trail_layer()
+    dirty_rects.invalidate()  # Nothing else covers the old trails, e.g. while paused
+
 def reset_simulation():
     """Resets the simulation to the default initial conditions."""
-    global bodies, paused, speed_multiplier, trails
+    global bodies, state, paused, speed_multiplier, trails, step_rejections
     bodies = default_bodies()
+    state = load_bodies(bodies)
+    set_time_step(DEFAULT_DT)
+    set_gravity(DEFAULT_G)  # Also refreshes the accelerations and resets the diagnostics
     paused = False
     speed_multiplier = 1.0
-    trails = [[] for _ in bodies]  # Reset trails
+    trails = make_trails(len(bodies))  # Reset trails
+    clear_trail_layer()
+    dirty_rects.invalidate()
+    clear_speed_clamp_stats()
+    step_rejections = 0
+    camera.reset()
+
+# Camera
+class Camera:
+    """Zoomable, pannable view that can follow the center of mass or one body.
+
+    Maps world coordinates to the screen as screen = world * scale + offset.
+    """
+
+    MIN_ZOOM, MAX_ZOOM = 0.02, 50.0
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.zoom = 1.0
+        self.center = np.zeros(2)  # World point shown in the middle of the screen
+        self.mode = 'com'  # 'com', 'body' or 'free'
+        self.body = 0  # Followed body in 'body' mode
+
+    def update(self, state):
+        """Moves the view along with the followed target; call once per frame."""
+        if self.mode == 'com':
+            self.center = np.zeros(2)  # The state is barycentric, so the center of mass is the origin
+        elif self.mode == 'body' and self.body < len(state['pos']):
+            self.center = state['pos'][self.body].astype(float)
+
+    def transform(self):
+        """Returns the (scale, offset) that maps world coordinates to screen pixels."""
+        scale = SCALE * self.zoom
+        return scale, np.array([WIDTH / 2, HEIGHT / 2]) - self.center * scale
+
+    def screen_to_world(self, pos):
+        scale, offset = self.transform()
+        return (np.asarray(pos, dtype=float) - offset) / scale
+
+    def zoom_at(self, factor, screen_pos):
+        """Zooms by factor, keeping the world point under screen_pos in place (or the followed target)."""
+        zoom = min(max(self.zoom * factor, self.MIN_ZOOM), self.MAX_ZOOM)
+        if self.mode == 'free':
+            anchor = self.screen_to_world(screen_pos)
+            self.center = anchor + (self.center - anchor) * (self.zoom / zoom)
+        self.zoom = zoom
+
+    def pan(self, dx, dy):
+        """Moves the view by a screen distance and stops following."""
+        self.mode = 'free'
+        self.center = self.center - np.array([dx, dy]) / (SCALE * self.zoom)
+
+    def follow_com(self):
+        self.mode = 'com'
+
+    def follow_body(self, i):
+        self.mode = 'body'
+        self.body = i
+
+    def label(self):
+        target = {'com': "COM", 'body': f"body {self.body + 1}", 'free': "free"}[self.mode]
+        return f"Zoom x{self.zoom:.2f} | {target}"
+
+camera = Camera()
+dragging = False  # Whether the view is being panned with the mouse
+
+# View transform: screen = world * scale + offset
+def view_transform():
+    """Returns the (scale, offset) that maps world coordinates to screen pixels."""
+    return camera.transform()
+
+def on_screen(lo, hi, margin=0):
+    """Returns whether boxes with screen corners lo and hi (arrays of shape (..., 2)) overlap the viewport."""
+    return ((hi[..., 0] >= -margin) & (hi[..., 1] >= -margin) &
+            (lo[..., 0] < WIDTH + margin) & (lo[..., 1] < HEIGHT + margin))
+
+def visible_runs(points, bounds):
+    """Returns which runs points[bounds[k]:bounds[k + 1] + 1] of a polyline can be seen (bounding box test)."""
+    starts, ends = np.asarray(bounds[:-1]), np.asarray(bounds[1:])
+    lo = np.minimum(np.minimum.reduceat(points, starts), points[ends])
+    hi = np.maximum(np.maximum.reduceat(points, starts), points[ends])
+    return on_screen(lo, hi, margin=2)
+
+def world_to_screen(points, transform=None):
+    """Projects an (..., 2) array of world coordinates to (float) screen pixels."""
+    scale, offset = transform or view_transform()
+    return points * scale + offset
+
+def project_trails():
+    """Projects the trails of all bodies to the screen with one vectorized transform.
+
+    Returns one (n, 2) float array per body, oldest point first.
+    """
+    views = [trails.view(i) for i in range(len(trails))]
+    if trail_stride > 1:
+        views = [view[::-trail_stride][::-1] for view in views]  # Thinned from the newest point back
+    if not views:
+        return []
+    projected = world_to_screen(np.concatenate(views))
+    return np.split(projected, np.cumsum([len(view) for view in views])[:-1])
+
+# Trail rendering
+TRAIL_MODES = ['lines', 'points', 'fade', 'raster']
+trail_mode = 'lines'  # 'points' draws every trail point as a circle (slow, for comparison)
+trail_fade_buckets = 16  # Color steps along each trail: more is smoother, fewer is faster
+trail_antialias = False  # Antialiased polylines look better but cost more
+trail_cull_run = 128  # Longest run of trail points culled (and drawn) as one polyline
+trail_stride = 1  # Draws every trail_stride-th trail point (set by the quality governor)
+raster_stride = 1  # Draws every raster_stride-th point in 'raster' mode (set by the quality governor)
+
+# 'fade' mode: trails accumulate on an off-screen layer that is faded a little every frame,
+# so only the newest segment of each trail is drawn and the cost does not grow with trail length
+trail_layer = None  # Created at the screen size on first use
+trail_fade_mask = None  # Constant surface subtracted from the layer; blitting it is much faster than a blended fill
+trail_fade_step = 2  # Alpha taken off on every fade: a segment disappears after 255 / trail_fade_step fades
+trail_fade_interval = 1  # Frames between fades; larger values keep longer trails
+trail_layer_frames = 0
+trail_layer_transform = None  # (scale, offset) the layer's pixels were drawn with
 
-def get_center_of_mass():
-    """Computes the center of mass of the system to keep it centered in the view."""
-    total_mass = sum(body['mass'] for body in bodies)
-    center_of_mass = sum(body['pos'] * body['mass'] for body in bodies) / total_mass
-    return center_of_mass
+@functools.lru_cache(maxsize=64)
+def trail_palette(color, buckets):
+    """Returns the faded trail colors of one body color, oldest bucket first."""
+    return [tuple(int(c * (k + 0.5) / buckets) * 0.3 for c in color) for k in range(buckets)]
+
+def draw_trails_points(screen):
+    """Draws every visible trail point as a small circle, with its own fade color."""
+    for body, trail in zip(bodies, project_trails()):
+        visible = on_screen(trail, trail, margin=1)
+        for j in np.flatnonzero(visible).tolist():
+            fade_factor = j / len(trail)
+            trail_color = tuple(int(c * fade_factor) * 0.3 for c in body['color'])
+            pygame.draw.circle(screen, trail_color, trail[j].tolist(), 1)
+
+def draw_trails_lines(screen):
+    """Draws each trail as a few polylines, one per precomputed fade color.
+
+    Buckets longer than trail_cull_run points are split, and runs that are off
+    the screen are skipped before drawing.
+    """
+    draw_lines = pygame.draw.aalines if trail_antialias else pygame.draw.lines
+    for body, trail in zip(bodies, project_trails()):
+        if len(trail) < 2:
+            continue
+        buckets = min(trail_fade_buckets, len(trail) - 1)
+        bucket_bounds = np.linspace(0, len(trail) - 1, buckets + 1).astype(int)
+        bounds = np.union1d(bucket_bounds, np.arange(0, len(trail) - 1, trail_cull_run))
+        bounds = np.append(bounds[bounds < len(trail) - 1], len(trail) - 1)
+        palette = trail_palette(body['color'], buckets)
+        bucket = np.searchsorted(bucket_bounds, bounds[:-1], side='right') - 1
+        for k in np.flatnonzero(visible_runs(trail, bounds)).tolist():
+            start, end = bounds[k], bounds[k + 1]
+            draw_lines(screen, palette[bucket[k]], False, trail[start:end + 1].tolist())  # Shares the end point with the next run
+
+def draw_trails_fade(screen):
+    """Fades the accumulated trail layer, adds the newest segment of every trail and blits it."""
+    global trail_layer, trail_fade_mask, trail_layer_frames, trail_layer_transform
+    if trail_layer is None or trail_layer.get_size() != screen.get_size():
+        trail_layer = pygame.Surface(screen.get_size(), pygame.SRCALPHA)
+        trail_fade_mask = pygame.Surface(screen.get_size(), pygame.SRCALPHA)
+        trail_fade_mask.fill((0, 0, 0, trail_fade_step))
+        trail_layer_transform = None
+    align_trail_layer(view_transform())
+    if not paused:  # Keeps the trails frozen while paused
+        trail_layer_frames += 1
+        if trail_layer_frames % trail_fade_interval == 0:
+            # A subtraction reaches zero; multiplying by a factor below one gets stuck where the rounding stops lowering alpha
+            trail_layer.blit(trail_fade_mask, (0, 0), special_flags=pygame.BLEND_RGBA_SUB)
+        draw_line = pygame.draw.aaline if trail_antialias else pygame.draw.line
+        for i, body in enumerate(bodies):
+            trail = trails.tail(i, 2)
+            if len(trail) >= 2:
+                draw_line(trail_layer, body['color'] + (255,), *world_to_screen(trail).tolist())
+    screen.blit(trail_layer, (0, 0))
+
+def draw_trails_raster(screen):
+    """Writes all trail points straight into the screen pixels in one vectorized scatter.
+
+    Meant for very many points: the fade is a per-point weight, quantized to 256
+    levels of a per-body color ramp, and points outside the screen are dropped
+    before the write.
+    """
+    points, levels = [], []
+    for i in range(len(bodies)):
+        trail = trails.view(i)[::-raster_stride][::-1]
+        if len(trail):
+            points.append(trail)
+            # Oldest point is the faintest; the ramp of body i starts at row i * 256
+            levels.append(np.arange(1, len(trail) + 1) * 255 // len(trail) + i * 256)
+    if not points:
+        return
+    points = world_to_screen(np.concatenate(points)).astype(int)
+    levels = np.concatenate(levels)
+    width, height = screen.get_size()
+    visible = (points[:, 0] >= 0) & (points[:, 0] < width) & (points[:, 1] >= 0) & (points[:, 1] < height)
+    # Display pixel values, mapped by pygame so any pixel format works
+    mapped = np.concatenate([pygame.surfarray.map_array(screen, trail_ramp(body['color'])) for body in bodies])
+    pixels = pygame.surfarray.pixels2d(screen)  # Locks the screen until deleted
+    pixels[points[visible, 0], points[visible, 1]] = mapped[levels[visible]]
+    del pixels
+
+@functools.lru_cache(maxsize=256)
+def trail_ramp(color):
+    """Returns the 256 faded trail colors of one body color as a (256, 3) array."""
+    return (np.outer(np.arange(256) / 255 * 0.3, color)).astype(np.uint32)
+
+def align_trail_layer(transform):
+    """Keeps the accumulated trails in place when the camera moves.
+
+    A pan or a followed body scrolls the layer by whole pixels; a zoom cannot be
+    followed, so the layer is cleared.
+    """
+    global trail_layer_transform
+    scale, offset = transform
+    if trail_layer_transform is None or trail_layer_transform[0] != scale:
+        trail_layer.fill((0, 0, 0, 0))
+        trail_layer_transform = (scale, offset.copy())
+        return
+    dx, dy = np.round(offset - trail_layer_transform[1]).astype(int).tolist()
+    if dx or dy:
+        trail_layer.scroll(dx, dy)
+        width, height = trail_layer.get_size()
+        # Clears the strips uncovered by the scroll
+        trail_layer.fill((0, 0, 0, 0), pygame.Rect(0 if dx > 0 else width + dx, 0, abs(dx), height))
+        trail_layer.fill((0, 0, 0, 0), pygame.Rect(0, 0 if dy > 0 else height + dy, width, abs(dy)))
+        trail_layer_transform[1][:] += (dx, dy)
+
+def clear_trail_layer():
+    """Forgets the accumulated 'fade' trails, e.g. after a reset."""
+    global trail_layer
+    trail_layer = None
+
+TRAIL_RENDERERS = {
+    'lines': draw_trails_lines,
+    'points': draw_trails_points,
+    'fade': draw_trails_fade,
+    'raster': draw_trails_raster,
+}
+
+# Body sprites: antialiased discs with an optional glow halo, rendered once per color and on-screen radius
+body_glow = False  # Soft halo around every body (--glow); it costs more than the disc
+SPRITE_MAX_RADIUS = 32  # Larger discs are drawn with draw.circle, which is cheaper there and caches nothing
+body_antialias = True  # False draws every body with draw.circle (set by the quality governor)
+
+@functools.lru_cache(maxsize=128)  # At most about 9 MB, as no sprite is larger than SPRITE_MAX_RADIUS
+def body_sprite(color, radius, glow):
+    """Returns the sprite of a body disc with the given pixel radius, centered in the surface.
+
+    The radius already includes the camera zoom, so every zoom level that
+    rounds to the same radius shares a sprite. The edge is antialiased by
+    pixel coverage; the halo fades out over about one radius.
+    """
+    halo = max(3, radius) if glow else 0
+    size = 2 * (radius + halo) + 3
+    center = (size - 1) / 2
+    x, y = np.ogrid[:size, :size]
+    distance = np.sqrt((x - center) ** 2 + (y - center) ** 2)
+    alpha = np.clip(radius + 0.5 - distance, 0.0, 1.0)  # Coverage of the disc
+    if glow:
+        alpha = np.maximum(alpha, 0.35 * np.exp(-3 * ((distance - radius) / halo) ** 2) * (distance < radius + halo))
+    sprite = pygame.Surface((size, size), pygame.SRCALPHA)
+    sprite.fill(color)
+    pygame.surfarray.pixels_alpha(sprite)[...] = (alpha * 255).astype(np.uint8)
+    sprite = sprite.convert_alpha()
+    sprite.set_alpha(255, pygame.RLEACCEL)  # Run-length encoded alpha skips the transparent and opaque runs quickly
+    cached_surfaces['sprites'].add(sprite)
+    return sprite
+
+# Quality governor: lowers the drawing quality when frames take too long and raises it again when there is room
+QUALITY_LEVELS = [  # Best first; factors scale the settings chosen by the user
+    {'trail_stride': 1, 'raster_stride': 1, 'fade_buckets': 1.0, 'antialias': True, 'step_retries': 1.0},
+    {'trail_stride': 1, 'raster_stride': 1, 'fade_buckets': 0.5, 'antialias': False, 'step_retries': 1.0},
+    {'trail_stride': 2, 'raster_stride': 2, 'fade_buckets': 0.5, 'antialias': False, 'step_retries': 0.5},
+    {'trail_stride': 4, 'raster_stride': 4, 'fade_buckets': 0.25, 'antialias': False, 'step_retries': 0.5},
+    {'trail_stride': 8, 'raster_stride': 8, 'fade_buckets': 0.125, 'antialias': False, 'step_retries': 0.25},
+]
+quality_governor_enabled = True
+quality_level = 0  # Index into QUALITY_LEVELS
+quality_base = None  # The user's settings, captured when the level first changes
+frame_budget_ms = 1000 / 60  # Work (everything but waiting for the next tick) allowed per frame
+frame_work_ms = 0.0  # Moving average of the work per frame
+quality_high_frames = 0  # Consecutive frames over the budget
+quality_low_frames = 0  # Consecutive frames with plenty of room
+QUALITY_DOWN_FRAMES = 30  # Frames over 90% of the budget before the quality is lowered
+QUALITY_UP_FRAMES = 180  # Frames under 50% of the budget before it is raised again
+
+def apply_quality(level):
+    """Sets the quality knobs for one of QUALITY_LEVELS."""
+    global quality_level, quality_base, trail_stride, raster_stride, trail_fade_buckets, trail_antialias
+    global body_antialias, max_step_retries
+    if quality_base is None:
+        quality_base = {'fade_buckets': trail_fade_buckets, 'antialias': trail_antialias, 'step_retries': max_step_retries}
+    knobs = QUALITY_LEVELS[level]
+    quality_level = level
+    trail_stride = knobs['trail_stride']
+    raster_stride = knobs['raster_stride']
+    trail_fade_buckets = max(1, int(quality_base['fade_buckets'] * knobs['fade_buckets']))
+    trail_antialias = quality_base['antialias'] and knobs['antialias']
+    body_antialias = knobs['antialias']
+    max_step_retries = int(quality_base['step_retries'] * knobs['step_retries'])  # Each retry doubles the substeps
+
+def update_quality(work_ms):
+    """Feeds the work time of one frame to the governor, which may change the quality level.
+
+    The level only moves after the average stayed over (or well under) the
+    budget for a while, and the counters restart after every change, so the
+    quality does not flicker between two levels.
+    """
+    global frame_work_ms, quality_high_frames, quality_low_frames
+    frame_work_ms += 0.1 * (work_ms - frame_work_ms)
+    if not quality_governor_enabled:
+        return
+    quality_high_frames = quality_high_frames + 1 if frame_work_ms > 0.9 * frame_budget_ms else 0
+    quality_low_frames = quality_low_frames + 1 if frame_work_ms < 0.5 * frame_budget_ms else 0
+    if quality_high_frames >= QUALITY_DOWN_FRAMES and quality_level < len(QUALITY_LEVELS) - 1:
+        apply_quality(quality_level + 1)
+        quality_high_frames = 0
+    elif quality_low_frames >= QUALITY_UP_FRAMES and quality_level > 0:
+        apply_quality(quality_level - 1)
+        quality_low_frames = 0
+
+def toggle_quality_governor():
+    """Turns the governor on or off; turning it off restores the best quality."""
+    global quality_governor_enabled, quality_high_frames, quality_low_frames
+    quality_governor_enabled = not quality_governor_enabled
+    quality_high_frames = quality_low_frames = 0
+    if not quality_governor_enabled and quality_base is not None:
+        apply_quality(0)
+
+def quality_label():
+    governor = "auto" if quality_governor_enabled else "fixed"
+    return f"Quality {len(QUALITY_LEVELS) - quality_level}/{len(QUALITY_LEVELS)} ({governor})"
+
+def draw_body(screen, color, center, radius):
+    """Draws a body disc and returns the rect it covers; only sprite-sized bodies get a halo."""
+    if radius > SPRITE_MAX_RADIUS or not body_antialias:
+        return pygame.draw.circle(screen, color, center, radius)
+    sprite = body_sprite(color, radius, body_glow)
+    return screen.blit(sprite, sprite.get_rect(center=center))
+
+# Dirty rectangles: push only the changed parts of the screen to the display
+class DirtyRects:
+    """Collects the screen regions that changed since the last frame for pygame.display.update(rects).
+
+    The screen is still redrawn completely every frame; only the copy to the
+    display is limited. Moving things are added every frame (their previous
+    rects are pushed too, to erase them), other things are drawn as keyed items
+    that are only pushed when their content or place changes, or when they go
+    away. Anything that changes the whole screen, such as a scrolling background
+    or a camera move, invalidates the frame and falls back to a full flip.
+    """
+
+    MAX_FRACTION = 0.5  # Above this dirty share of the screen a full flip is used instead
+
+    def __init__(self):
+        self.enabled = False
+        self.rects = []  # Moving things drawn this frame
+        self.previous = []  # Moving things drawn last frame
+        self.items = {}  # key -> (content, rect) of the items drawn last
+        self.seen = set()  # Keys of the items drawn this frame
+        self.full = True  # Whether this frame must be flipped completely
+        self.frames = self.full_frames = 0
+        self.pixels_pushed = self.pixels_total = 0
+
+    def invalidate(self):
+        self.full = True
+
+    def toggle(self):
+        self.enabled = not self.enabled
+        self.full = True
+
+    def add(self, rect):
+        """Marks the rect of something that moves or changes every frame."""
+        self.rects.append(rect)
+
+    def item(self, key, content, rect):
+        """Marks rect dirty if the item drawn under key changed since the last frame."""
+        self.seen.add(key)
+        old = self.items.get(key)
+        if old != (content, rect):
+            self.rects.append(rect)
+            if old:
+                self.rects.append(old[1])
+            self.items[key] = (content, rect)
+
+    def present(self, screen):
+        """Updates the display, with dirty rects when enabled and worthwhile."""
+        area = screen.get_rect()
+        rects = self.rects + self.previous
+        rects += [self.items.pop(key)[1] for key in self.items.keys() - self.seen]  # Erases what went away
+        rects = [rect.clip(area) for rect in rects]
+        pixels = sum(rect.width * rect.height for rect in rects)  # Overlaps count twice: an upper bound
+        full = self.full or not self.enabled or pixels > area.width * area.height * self.MAX_FRACTION
+        if full:
+            pygame.display.flip()
+        else:
+            pygame.display.update([rect for rect in rects if rect])
+        if self.enabled:
+            self.frames += 1
+            self.full_frames += full
+            self.pixels_pushed += area.width * area.height if full else pixels
+            self.pixels_total += area.width * area.height
+        self.previous, self.rects = self.rects, []
+        self.seen = set()
+        self.full = False
+
+    def report(self):
+        if self.frames:
+            saved = self.pixels_total - self.pixels_pushed
+            print(f"Dirty rects over {self.frames} frames: {self.full_frames} full flips, "
+                  f"{saved / self.pixels_total:.1%} of the pixel bandwidth saved ({saved * 4 / 1e6:.0f} MB at 4 bytes per pixel)")
+
+dirty_rects = DirtyRects()
+background_scroll = True  # False keeps the background still, so dirty rects also pay off while running
+
+def trail_bounds():
+    """Returns the screen bounding rect of every non-empty trail."""
+    rects = []
+    for trail in project_trails():
+        if len(trail):
+            (x0, y0), (x1, y1) = trail.min(axis=0).astype(int).tolist(), trail.max(axis=0).astype(int).tolist()
+            rects.append(pygame.Rect(x0 - 1, y0 - 1, x1 - x0 + 3, y1 - y0 + 3))
+    return rects
+
+# HUD text: rendered text is cached, and fast-changing numbers are only refreshed a few times a second
+hud_refresh_interval = 6  # Frames between refreshes of fast-changing HUD numbers (10 times a second at 60 FPS)
+hud_frame = 0
+hud_values = {}  # key -> value last sampled for the HUD
+
+@functools.lru_cache(maxsize=256)
+def render_text(text, color=(255, 255, 255)):
+    """Returns text rendered with button_font; a string is only rasterized again after it was evicted."""
+    surface = button_font.render(text, True, color)
+    cached_surfaces['text'].add(surface)
+    return surface
+
+def hud_value(key, value):
+    """Returns value as last sampled for the HUD, refreshed every hud_refresh_interval frames."""
+    if key not in hud_values or hud_frame % hud_refresh_interval == 0:
+        hud_values[key] = value
+    return hud_values[key]
+
+# UI widgets: created once, drawn from pre-rendered surfaces and driven by the events they receive
+BUTTON_COLOR = (50, 50, 150)
+HOVER_COLOR = (70, 70, 200)
+ACTIVE_COLOR = (40, 120, 90)  # Toggles that are on
+ACTIVE_HOVER_COLOR = (60, 160, 120)
+TEXT_COLOR = (255, 255, 255)
+
+def render_widget(size, color, label):
+    """Returns a rounded widget face of the given size with its label."""
+    surface = pygame.Surface(size, pygame.SRCALPHA)
+    pygame.draw.rect(surface, color, surface.get_rect(), border_radius=10)
+    surface.blit(render_text(label, TEXT_COLOR), (10, 5))
+    return surface.convert_alpha()
+
+class Button:
+    """Push button calling action() when clicked; its normal and hover faces are rendered once."""
+
+    def __init__(self, rect, label, action):
+        self.rect = pygame.Rect(rect)
+        self.label = label
+        self.action = action
+        self.hovered = False
+        self.faces = None  # Rendered on the first draw, when the font exists
+
+    def render_faces(self):
+        return {False: render_widget(self.rect.size, BUTTON_COLOR, self.label),
+                True: render_widget(self.rect.size, HOVER_COLOR, self.label)}
+
+    def state(self):
+        return self.hovered
+
+    def handle(self, event):
+        """Reacts to a pygame event; returns whether the event was used."""
+        if event.type == pygame.MOUSEMOTION:
+            self.hovered = self.rect.collidepoint(event.pos)
+        elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.rect.collidepoint(event.pos):
+            self.action()
+            return True
+        return False
+
+    def draw(self, screen):
+        """Blits the face for the current state and returns that state."""
+        if self.faces is None:
+            self.faces = self.render_faces()
+        state = self.state()
+        screen.blit(self.faces[state], self.rect)
+        return state
+
+class Toggle(Button):
+    """Button showing an on/off setting read from is_on()."""
+
+    def __init__(self, rect, label, action, is_on):
+        super().__init__(rect, label, action)
+        self.is_on = is_on
+
+    def render_faces(self):
+        return {(False, False): render_widget(self.rect.size, BUTTON_COLOR, self.label),
+                (False, True): render_widget(self.rect.size, HOVER_COLOR, self.label),
+                (True, False): render_widget(self.rect.size, ACTIVE_COLOR, self.label),
+                (True, True): render_widget(self.rect.size, ACTIVE_HOVER_COLOR, self.label)}
+
+    def state(self):
+        return (bool(self.is_on()), self.hovered)
+
+class Slider(Button):
+    """Horizontal slider for a value between low and high, read with get() and written with set().
+
+    Dragging moves the value; a slider that is not `live` only calls set() when
+    released, for settings that are expensive to change. The face is rendered
+    again only when the shown value or the hover state changes.
+    """
+
+    def __init__(self, rect, label, get, set, low, high, fmt="{:.2f}", live=True):
+        super().__init__(rect, label, None)
+        self.get, self.set = get, set
+        self.low, self.high = low, high
+        self.fmt = fmt
+        self.live = live
+        self.dragged = None  # Value being dragged, None when not dragging
+        self.faces = {}
+        self.face_state = None
+
+    def value_at(self, x):
+        fraction = min(max((x - self.rect.x) / self.rect.width, 0.0), 1.0)
+        return self.low + fraction * (self.high - self.low)
+
+    def state(self):
+        value = self.get() if self.dragged is None else self.dragged
+        return (self.fmt.format(value), value, self.hovered or self.dragged is not None)
+
+    def handle(self, event):
+        if event.type == pygame.MOUSEBUTTONDOWN and event.button == 1 and self.rect.collidepoint(event.pos):
+            self.dragged = self.value_at(event.pos[0])
+        elif event.type == pygame.MOUSEMOTION:
+            self.hovered = self.rect.collidepoint(event.pos)
+            if self.dragged is None:
+                return False
+            self.dragged = self.value_at(event.pos[0])
+        elif event.type == pygame.MOUSEBUTTONUP and event.button == 1 and self.dragged is not None:
+            self.set(self.dragged)
+            self.dragged = None
+            return True
+        else:
+            return False
+        if self.live:
+            self.set(self.dragged)
+        return True
+
+    def draw(self, screen):
+        state = self.state()
+        if state != self.face_state:
+            text, value, hovered = state
+            face = render_widget(self.rect.size, HOVER_COLOR if hovered else BUTTON_COLOR, f"{self.label} {text}")
+            fraction = (value - self.low) / (self.high - self.low)
+            bar = pygame.Rect(8, self.rect.height - 6, max(2, int(fraction * (self.rect.width - 16))), 3)  # Value bar under the label
+            pygame.draw.rect(face, ACTIVE_HOVER_COLOR, bar)
+            self.faces, self.face_state = face, state
+        screen.blit(self.faces, self.rect)
+        return state
+
+widgets = []
+
+def make_widgets():
+    """Creates the control bar along the bottom of the screen.
+
+    The sliders follow the buttons when the screen is wide enough, and get a
+    row of their own above them otherwise.
+    """
+    y = HEIGHT - 50
+    x, slider_y = (620, y) if WIDTH >= 1120 else (10, y - 40)
+    return [
+        Toggle((10, y, 70, 30), "Pause", toggle_pause, lambda: paused),
+        Button((100, y, 70, 30), "Reset", reset_simulation),
+        Button((200, y, 30, 30), "+", lambda: adjust_speed(0.1)),
+        Button((240, y, 30, 30), "-", lambda: adjust_speed(-0.1)),
+        Toggle((360, y, 110, 30), "Info bodies", toggle_display_info, lambda: display_info),
+        Toggle((490, y, 110, 30), "Diagnostics", toggle_diagnostics, lambda: diagnostics_enabled),
+        Slider((x, slider_y, 150, 30), "dt", lambda: dt, set_time_step, 0.001, 0.05, fmt="{:.3f}"),
+        Slider((x + 160, slider_y, 150, 30), "G", lambda: G, set_gravity, 0.1, 5.0),
+        # Longer trails than the memory budget allows would be cut by trail_capacity()
+        Slider((x + 320, slider_y, 170, 30), "Trail", lambda: max_trail_length, set_trail_length,
+               100, trail_memory_budget // (len(bodies) * 16), fmt="{:.0f}", live=False),
+    ]
+
+def dispatch_event(event):
+    """Passes an event to every widget; returns whether one of them used it."""
+    used = False
+    for widget in widgets:
+        used = widget.handle(event) or used
+    return used
+
+def draw_widgets(screen):
+    for widget in widgets:
+        dirty_rects.item(widget, widget.draw(screen), widget.rect)
+
+# Idle throttling: paused frames are only drawn when an event arrives, and an unfocused or minimized window runs slowly
+FRAME_RATE = 60
+UNFOCUSED_FRAME_RATE = 10
+MINIMIZED_FRAME_RATE = 2
+idle_poll_ms = 250  # Longest blocking wait for an event while paused
+window_focused = True
+window_minimized = False
+
+def handle_window_event(event):
+    """Tracks the focus and minimized state of the window."""
+    global window_focused, window_minimized
+    if event.type == pygame.WINDOWFOCUSLOST:
+        window_focused = False
+    elif event.type == pygame.WINDOWFOCUSGAINED:
+        window_focused = True
+    elif event.type == pygame.WINDOWMINIMIZED:
+        window_minimized = True
+    elif event.type in (pygame.WINDOWRESTORED, pygame.WINDOWSHOWN):
+        window_minimized = False
+
+def frame_rate():
+    """Returns the frame rate to run at, lower when nobody is looking."""
+    if window_minimized:
+        return MINIMIZED_FRAME_RATE
+    return FRAME_RATE if window_focused else UNFOCUSED_FRAME_RATE
+
+async def wait_for_input():
+    """Waits a while for an event and leaves it queued for the next frame; returns whether one arrived.
+
+    The desktop blocks in pygame.event.wait, which returns as soon as there is
+    input. The web build must not block the browser, so it polls once a frame.
+    """
+    if sys.platform == 'emscripten':
+        await asyncio.sleep(1 / FRAME_RATE)
+        return bool(pygame.event.peek())
+    event = pygame.event.wait(idle_poll_ms)
+    await asyncio.sleep(0)
+    if event.type == pygame.NOEVENT:
+        return False
+    pygame.event.post(event)
+    return True
+
+def open_window(size, fullscreen=False):
+    """Opens the window (or switches its size) and lays everything out for it.
+
+    The camera and the HUD read WIDTH and HEIGHT every frame, so they follow
+    by themselves; the background and the widgets are rebuilt for the size.
+    """
+    global WIDTH, HEIGHT, widgets, window_fullscreen
+    if fullscreen:
+        screen = pygame.display.set_mode((0, 0), pygame.FULLSCREEN)
+    else:
+        screen = pygame.display.set_mode(size, pygame.RESIZABLE)
+    window_fullscreen = fullscreen
+    WIDTH, HEIGHT = screen.get_size()
+    build_background(screen.get_size())
+    widgets = make_widgets()
+    dirty_rects.invalidate()
+    return screen
+
+window_fullscreen = False
+windowed_size = (WIDTH, HEIGHT)  # Size to return to when leaving fullscreen
+
+# Performance HUD (F3): frame rate, frame time percentiles, milliseconds per phase and counts
+perf_hud_enabled = False
+perf_hud_surface = None
+perf_hud_mark = None  # (time, frames, phase totals, Euler steps) when the HUD was last refreshed
+
+def toggle_perf_hud():
+    global perf_hud_enabled, perf_hud_mark
+    perf_hud_enabled = not perf_hud_enabled
+    perf_hud_mark = None
+
+def perf_hud_lines():
+    """Returns the HUD lines for the frames since the last call, or None if no frame was timed since."""
+    global perf_hud_mark
+    mark = (time.perf_counter_ns(), timed_frames, frame_phase_ns.copy(), euler_steps)
+    previous, perf_hud_mark = perf_hud_mark, mark
+    if previous is None or mark[1] == previous[1] or not frame_times_ns:
+        return None
+    seconds = (mark[0] - previous[0]) / 1e9
+    frames = mark[1] - previous[1]
+    times = np.array(frame_times_ns) / 1e6
+    phases = " ".join(f"{name} {(total - previous[2][name]) / frames / 1e6:.1f}" for name, total in mark[2].items())
+    points = sum(len(trails.view(i)) for i in range(len(trails)))
+    return [
+        f"FPS {frames / seconds:.0f} | frame p50 {np.percentile(times, 50):.1f} ms p99 {np.percentile(times, 99):.1f} ms",
+        f"ms: {phases}",
+        f"Physics {(mark[3] - previous[3]) / seconds:.0f} steps/s | {len(bodies)} bodies | {points} trail points",
+        "Memory (KB): " + " ".join(f"{name} {size / 1024:.0f}" for name, size in memory_usage().items()),
+    ]
+
+def draw_perf_hud(screen):
+    """Draws the performance HUD, refreshed every hud_refresh_interval frames."""
+    global perf_hud_surface
+    if hud_frame % hud_refresh_interval == 0 or perf_hud_surface is None:
+        lines = perf_hud_lines()
+        if lines:
+            # Rendered directly: the numbers change on every refresh, so caching them would only evict other text
+            rendered = [button_font.render(line, True, TEXT_COLOR) for line in lines]
+            perf_hud_surface = pygame.Surface((max(line.get_width() for line in rendered) + 12, 22 * len(rendered) + 8), pygame.SRCALPHA)
+            perf_hud_surface.fill((0, 0, 0, 160))
+            for k, line in enumerate(rendered):
+                perf_hud_surface.blit(line, (6, 5 + 22 * k))
+    if perf_hud_surface is not None:
+        dirty_rects.item('perf', id(perf_hud_surface), screen.blit(perf_hud_surface, (10, 60)))
+
+# Profiling (F9, or --profile N): cProfile and a stack sampler over a window of frames, while the loop keeps running
+profile_frame_count = 300  # Frames profiled per F9 press
+profile_at_start = 0  # Frames to profile from the first frame (--profile)
+profile_sample_interval = 0.001  # Seconds between stack samples
+profiler = None  # The active FrameProfiler
+
+class FrameProfiler:
+    """Profiles the next `frames` frames of the main loop and writes the results.
+
+    cProfile writes `<prefix>.prof`, which pstats or snakeviz can read. A
+    sampler thread records the stack of the loop every profile_sample_interval
+    seconds into `<prefix>.collapsed`, one `frame;frame;... count` line per
+    stack, which is the input of flamegraph.pl and speedscope. Both files are
+    written by a background thread (the web build writes the .prof directly).
+    """
+
+    def __init__(self, frames, prefix):
+        self.frames_left = frames
+        self.prefix = prefix
+        self.profile = cProfile.Profile()
+        self.samples = Counter()
+        self.thread_id = threading.get_ident()
+        self.done = threading.Event()
+        self.sampler = None
+        if sys.platform != 'emscripten':  # No threads in the web build
+            self.sampler = threading.Thread(target=self.sample, daemon=True)
+            self.sampler.start()
+        self.profile.enable()
+
+    def sample(self):
+        while not self.done.wait(profile_sample_interval):
+            frame = sys._current_frames().get(self.thread_id)
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                frame = frame.f_back
+            self.samples[";".join(reversed(stack))] += 1
+
+    def end_frame(self):
+        """Counts a profiled frame; returns whether the window is complete."""
+        self.frames_left -= 1
+        if self.frames_left > 0:
+            return False
+        self.profile.disable()
+        self.done.set()
+        if self.sampler is None:
+            self.write()  # No threads in the web build
+        else:
+            threading.Thread(target=self.write).start()
+        return True
+
+    def write(self):
+        self.profile.dump_stats(self.prefix + ".prof")
+        if self.sampler is None:
+            print(f"Profile written to {self.prefix}.prof")
+            return
+        self.sampler.join()
+        with open(self.prefix + ".collapsed", "w") as file:
+            for stack, count in self.samples.items():
+                file.write(f"{stack} {count}\n")
+        print(f"Profile written to {self.prefix}.prof and {self.prefix}.collapsed ({sum(self.samples.values())} samples)")
+
+def start_profiling(frames=None):
+    """Starts profiling the next frames (profile_frame_count by default), unless a profile is running."""
+    global profiler
+    if profiler is None:
+        profiler = FrameProfiler(frames or profile_frame_count, time.strftime("profile-%Y%m%d-%H%M%S"))
+
+def end_profiled_frame():
+    global profiler
+    if profiler is not None and profiler.end_frame():
+        profiler = None
+
+# Memory accounting (M, or --memory-report SECONDS): bytes per component; Shift+M (or --memory-growth) tracks growth with tracemalloc
+cached_surfaces = {name: weakref.WeakSet() for name in ('text', 'sprites', 'background')}  # Evicted surfaces drop out
+memory_report_interval = 0  # Seconds between periodic reports, 0 for none
+memory_growth_at_start = False  # Tracks growth from the first frame (--memory-growth)
+memory_snapshot = None  # tracemalloc snapshot to compare with, None while growth is not tracked
+
+def surface_bytes(surfaces):
+    return sum(surface.get_bytesize() * surface.get_width() * surface.get_height() for surface in surfaces if surface is not None)
+
+def container_bytes(container):
+    """Estimates the bytes of a container and its items (one level deep)."""
+    items = container.values() if isinstance(container, dict) else container
+    return sys.getsizeof(container) + sum(sys.getsizeof(item) for item in items)
+
+def memory_usage():
+    """Returns the bytes used by each component of the simulator."""
+    faces = []
+    for widget in widgets:
+        faces += widget.faces.values() if isinstance(widget.faces, dict) else [widget.faces]
+    return {
+        'state': sum(value.nbytes for value in state.values() if isinstance(value, np.ndarray)),
+        'trails': trails.nbytes,
+        'trail layer': surface_bytes([trail_layer, trail_fade_mask]),
+        'text cache': surface_bytes(cached_surfaces['text']),
+        'sprites': surface_bytes(cached_surfaces['sprites']),
+        'widgets': surface_bytes(faces),
+        'background': surface_bytes(cached_surfaces['background']) + surface_bytes([BACKGROUND_IMAGE]),
+        'recorders': sum(container_bytes(recorder) for recorder in (
+            diagnostics_history, speed_clamp_log, frame_times_ns, hud_values, dirty_rects.items,
+            *(histogram.buckets for histogram in histograms.values()))),
+    }
+
+def print_memory_report():
+    """Prints the memory used by each component, and the allocation growth if it is being tracked."""
+    global memory_snapshot
+    usage = memory_usage()
+    print("Memory (KB): " + " | ".join(f"{name} {size / 1024:.1f}" for name, size in usage.items())
+          + f" | total {sum(usage.values()) / 1024:.0f}")
+    if memory_snapshot is not None:
+        snapshot = take_memory_snapshot()
+        print_memory_growth(memory_snapshot, snapshot)
+        memory_snapshot = snapshot
+
+def take_memory_snapshot():
+    return tracemalloc.take_snapshot().filter_traces([tracemalloc.Filter(False, tracemalloc.__file__)])
+
+def print_memory_growth(before, after):
+    """Prints the source lines whose allocations grew most between two snapshots."""
+    print("Largest allocation growth since the last snapshot:")
+    growth = [difference for difference in after.compare_to(before, 'lineno') if difference.size_diff > 0]
+    for difference in growth[:10]:
+        print(f"  {difference}")
+
+def toggle_memory_growth():
+    """Starts tracking allocations with tracemalloc, or prints the growth since the start and stops.
+
+    tracemalloc slows every allocation several times over, so it only runs
+    between the two toggles (or for the whole run with --memory-growth).
+    """
+    global memory_snapshot
+    if memory_snapshot is None:
+        tracemalloc.start()
+        memory_snapshot = take_memory_snapshot()
+        print("Tracking memory growth (Shift+M again to report and stop)")
+    else:
+        print_memory_growth(memory_snapshot, take_memory_snapshot())
+        memory_snapshot = None
+        tracemalloc.stop()
 
 async def main():
     """Runs the simulation loop using Pygame to visualize motion and add UI controls."""
-    global button_font, background_x, background_y, elapsed_time
-    screen = pygame.display.set_mode((WIDTH, HEIGHT))
-    clock = pygame.time.Clock()
+    global button_font, background_x, background_y, elapsed_time, hud_frame, windowed_size
     button_font = pygame.font.Font(None, 25)
+    render_text.cache_clear()  # Cached text belongs to the previous font
+    screen = open_window((WIDTH, HEIGHT))
+    clock = pygame.time.Clock()
+    if profile_at_start:
+        start_profiling(profile_at_start)  # Starts with the loop, so the setup above is not in the profile
+    if memory_growth_at_start:
+        toggle_memory_growth()
+    if memory_report_interval:
+        print_memory_report()
+    next_memory_report = time.monotonic() + memory_report_interval
     elapsed_time = 0  # Initialize simulation time in days
     running = True
+    last_transform = None
     
     while running:
-        global bg_x, bg_y, bg_x_speed, bg_y_speed
-        screen.fill((0,0,0)) #redraws BG
-        screen.blit(BACKGROUND_IMAGE, (bg_x,bg_y)) #x,y; x changes in nagativ direction: to the left
-        screen.blit(BACKGROUND_IMAGE, (WIDTH + bg_x, HEIGHT + bg_y)) # image to the right bottom (diagonally)
-        screen.blit(BACKGROUND_IMAGE, (WIDTH + bg_x, bg_y)) # image to the right
-        if (bg_y<=-HEIGHT):
-            screen.blit(BACKGROUND_IMAGE, (WIDTH + bg_x, HEIGHT + bg_y))
-            bg_y=0
-        elif (bg_x<=-HEIGHT):
-            screen.blit(BACKGROUND_IMAGE, (WIDTH + bg_x, HEIGHT + bg_y))
-            bg_x=0
-        bg_x -= bg_x_speed
-        bg_y -= bg_y_speed
-        
-        ###########
-
-
+        if paused and not pygame.event.peek():
+            suspend_frame_timing()  # Waiting is not a slow frame
+            if not await wait_for_input():
+                continue  # Nothing changed, and the last frame is still on the screen
+        start_frame_timing()
+        hud_frame += 1
+        scroll = background_scroll and not paused  # A still background lets paused frames wait for input
+        draw_background(screen, scroll)
+        if scroll:
+            dirty_rects.invalidate()
+        end_phase('background')
 
         if not paused:
-            update_positions(bodies, dt)  
+            update_positions(state, dt)
             elapsed_time += dt *100 * speed_multiplier  # Update simulation time in days 
+        end_phase('physics')
         
-        center_of_mass = get_center_of_mass()
-        
+        trails.append(state['pos'])
+        camera.update(state)
+        transform = view_transform()
+        if last_transform is None or transform[0] != last_transform[0] or not np.array_equal(transform[1], last_transform[1]):
+            dirty_rects.invalidate()  # Everything on screen moves with the camera
+        last_transform = transform
+        screen_pos = world_to_screen(state['pos']).astype(int)
+
+        # Draw trails
+        TRAIL_RENDERERS[trail_mode](screen)
+        if dirty_rects.enabled and not paused:
+            if trail_mode == 'fade':
+                dirty_rects.invalidate()  # The whole layer fades
+            else:
+                for rect in trail_bounds():  # Fade colors shift along the whole trail as it grows
+                    dirty_rects.add(rect)
+        end_phase('trails')
+
         for i, body in enumerate(bodies):
-            pos_adjusted = (body['pos'] - center_of_mass) * SCALE + np.array([WIDTH / 2, HEIGHT / 2])
-            x, y = int(pos_adjusted[0]), int(pos_adjusted[1])
+            x, y = screen_pos[i].tolist()
             radius = int(body['mass'] * 5)  
-            
-            # Draw trails
-            trails[i].append((x, y))
-            if len(trails[i]) > max_trail_length:
-                trails[i].pop(0)
-            for j, trail_pos in enumerate(trails[i]):
-                fade_factor = j / len(trails[i])
-                trail_color = tuple(int(c * fade_factor) * 0.3 for c in body['color'])
-                pygame.draw.circle(screen, trail_color, trail_pos, 1)
-
+            draw_radius = min(max(2, int(radius * camera.zoom)), 400)
+            if not on_screen(screen_pos[i], screen_pos[i], margin=2 * draw_radius + 2):
+                continue  # Culled: nothing of the body (its halo or its info) would be visible
 
             # Draw bodies
-            pygame.draw.circle(screen, body['color'], (x, y), radius)
-            pygame.draw.circle(screen, body['color'], (x, y), radius, 1)  # White outline
-
+            body_rect = draw_body(screen, body['color'], (x, y), draw_radius)
+            dirty_rects.item(('body', i), body['color'], body_rect)
 
-            # Calculate speed in km/s
-            speed_km_s = np.linalg.norm(body['vel']) * 30  # Assuming 1 velocity unit = 30 km/s (earth speed)
 
-            # Display mass, size, and speed
-            info_text = f"Mass: {body['mass']:.1f}x Sun | Radius: {radius * 700}k km | Vel: {speed_km_s:.1f} km/s"
-            info_surface = button_font.render(info_text, True, (255, 255, 255))
             if display_info:
-                screen.blit(info_surface, (x + 10, y - 10))  # Position text near body
+                # Calculate speed in km/s
+                speed_km_s = hud_value(('speed', i), np.linalg.norm(body['vel'] + barycenter['vel']) * 30)  # World frame. Assuming 1 velocity unit = 30 km/s (earth speed)
 
-        # UI Buttons
-        button_color = (50, 50, 150)  
-        hover_color = (70, 70, 200)  
-        text_color = (255, 255, 255)  
+                # Display mass, size, and speed
+                info_text = f"Mass: {body['mass']:.1f}x Sun | Radius: {radius * 700}k km | Vel: {speed_km_s:.1f} km/s"
+                info_rect = screen.blit(render_text(info_text), (x + 10, y - 10))  # Position text near body
+                dirty_rects.item(('info', i), info_text, info_rect)
+        end_phase('bodies')
 
-        buttons = [
-            {"rect": pygame.Rect(10, HEIGHT - 50, 70, 30), "label": "Pause", "action": toggle_pause},
-            {"rect": pygame.Rect(100, HEIGHT - 50, 70, 30), "label": "Reset", "action": reset_simulation},
-            {"rect": pygame.Rect(200, HEIGHT - 50, 30, 30), "label": "+", "action": lambda: adjust_speed(0.1)},
-            {"rect": pygame.Rect(240, HEIGHT - 50, 30, 30), "label": "-", "action": lambda: adjust_speed(-0.1)},
-            {"rect": pygame.Rect(360, HEIGHT - 50, 110, 30), "label": "Info bodies", "action": toggle_display_info},
-        ]
+        text_color = TEXT_COLOR
 
+        global dragging
         for event in pygame.event.get():
+            handle_window_event(event)
+            if dispatch_event(event):
+                continue  # Used by a widget
             if event.type == pygame.QUIT:
                 running = False
-            elif event.type == pygame.MOUSEBUTTONDOWN:
-                for button in buttons:
-                    if button["rect"].collidepoint(event.pos):
-                        button["action"]()
-
-        # Draw buttons
-        mouse_x, mouse_y = pygame.mouse.get_pos()
-        for button in buttons:
-            rect = button["rect"]
-            color = hover_color if rect.collidepoint(mouse_x, mouse_y) else button_color  
-            pygame.draw.rect(screen, color, rect, border_radius=10)  
-            label_surface = button_font.render(button["label"], True, text_color)
-            screen.blit(label_surface, (rect.x + 10, rect.y + 5))  
+            elif event.type == pygame.VIDEORESIZE and not window_fullscreen:
+                windowed_size = event.size
+                screen = open_window(event.size)
+            elif event.type == pygame.MOUSEBUTTONDOWN and event.button == 1:
+                dragging = True  # Dragging the empty sky pans the view
+            elif event.type == pygame.MOUSEBUTTONUP and event.button == 1:
+                dragging = False
+            elif event.type == pygame.MOUSEMOTION and dragging:
+                camera.pan(*event.rel)
+            elif event.type == pygame.MOUSEWHEEL:
+                camera.zoom_at(1.1 ** event.y, pygame.mouse.get_pos())
+            elif event.type == pygame.KEYDOWN:
+                if event.key == pygame.K_c:
+                    camera.follow_com()
+                elif event.key == pygame.K_0:
+                    camera.reset()
+                elif pygame.K_1 <= event.key <= pygame.K_9 and event.key - pygame.K_1 < len(bodies):
+                    camera.follow_body(event.key - pygame.K_1)
+                elif event.key == pygame.K_d:
+                    dirty_rects.toggle()
+                elif event.key == pygame.K_q:
+                    toggle_quality_governor()
+                elif event.key == pygame.K_F3:
+                    toggle_perf_hud()
+                elif event.key == pygame.K_F9:
+                    start_profiling()
+                elif event.key == pygame.K_t:
+                    toggle_trace()
+                elif event.key == pygame.K_h:
+                    print_histogram_report()
+                elif event.key == pygame.K_m:
+                    if event.mod & pygame.KMOD_SHIFT:
+                        toggle_memory_growth()
+                    else:
+                        print_memory_report()
+                elif event.key == pygame.K_F11 or event.key == pygame.K_f:
+                    screen = open_window(windowed_size, not window_fullscreen)
+
+        draw_widgets(screen)
 
         # Display elapsed time
         years = elapsed_time / 365  
         centuries = years / 100  
-        time_text = button_font.render(f"Time: {years:.1f} earth years", True, text_color)
+        time_label = f"Time: {years:.1f} earth years"
+        time_text = render_text(time_label, text_color)
         #time_text = button_font.render(f"Time: {elapsed_time:.1f} days ({years:.2f} years, {centuries:.2f} centuries)", True, text_color)
-        screen.blit(time_text, (10, 10))
+        dirty_rects.item('time', time_label, screen.blit(time_text, (10, 10)))
+
+        # Display camera zoom and target (wheel: zoom, drag: pan, C/1-9: follow, 0: reset view)
+        camera_text = render_text(camera.label(), text_color)
+        dirty_rects.item('camera', camera.label(), screen.blit(camera_text, (WIDTH - camera_text.get_width() - 10, 10)))
+
+        # Display the drawing quality chosen by the governor (Q: on/off)
+        quality_text = render_text(quality_label(), text_color)
+        dirty_rects.item('quality', quality_label(), screen.blit(quality_text, (WIDTH - quality_text.get_width() - 10, 35)))
+
+        # Display conserved quantity drift
+        if diagnostics_enabled and diagnostics_history:
+            drifts = hud_value('drifts', diagnostics_history[-1])
+            drift_color = (255, 80, 80) if drift_alarms else text_color
+            drift_text = render_text(f"Drift E: {drifts['energy']:.1e} | P: {drifts['momentum']:.1e} | L: {drifts['angular_momentum']:.1e} | Rejected steps: {step_rejections}", drift_color)
+            dirty_rects.item('drift', (drifts, drift_color, step_rejections), screen.blit(drift_text, (10, 35)))
+
+        if perf_hud_enabled:
+            draw_perf_hud(screen)
 
         # Display speed multiplier value
-        speed_text = button_font.render(f"x{speed_multiplier:.1f}", True, text_color)  
-        screen.blit(speed_text, (280, HEIGHT - 45))  
+        speed_text = render_text(f"x{speed_multiplier:.1f}", text_color)  
+        dirty_rects.item('speed', speed_multiplier, screen.blit(speed_text, (280, HEIGHT - 45)))
+        end_phase('ui')
 
-        pygame.display.flip()
+        dirty_rects.present(screen)
+        end_phase('flip')
+        update_quality((time.perf_counter_ns() - frame_start_ns) / 1e6)
 
-    
-        clock.tick(60)
+        clock.tick(frame_rate())
+        end_phase('wait')
         
         await asyncio.sleep(0)
+        end_phase('yield')
+        end_profiled_frame()
+        if memory_report_interval and time.monotonic() >= next_memory_report:
+            print_memory_report()
+            next_memory_report += memory_report_interval
 
+    stop_trace()
     pygame.quit()
+    print_speed_clamp_summary()
+    print_frame_timing_report()
+    print_histogram_report()
+    dirty_rects.report()
+
+def parse_args(argv=None):
+    """Parses the command line options of the simulator."""
+    parser = argparse.ArgumentParser(description="Three body problem simulation")
+    parser.add_argument('--precision', choices=list(PRECISION_MODES), default=precision,
+                        help="floating point precision of the simulation state")
+    parser.add_argument('--diagnostics', action='store_true',
+                        help="monitor the drift of energy, momentum and angular momentum")
+    parser.add_argument('--trail-mode', choices=TRAIL_MODES, default=trail_mode,
+                        help="how trails are drawn")
+    parser.add_argument('--trail-buckets', type=int, default=trail_fade_buckets,
+                        help="fade color steps per trail (quality vs speed)")
+    parser.add_argument('--trail-aa', action='store_true',
+                        help="draw antialiased trails")
+    parser.add_argument('--no-trail-lod', action='store_true',
+                        help="keep the whole trail history at full resolution")
+    parser.add_argument('--glow', action='store_true',
+                        help="draw a glow halo around the bodies")
+    parser.add_argument('--perf-hud', action='store_true',
+                        help="show frame rate and frame phase timings (toggle with F3)")
+    parser.add_argument('--profile', type=int, metavar='FRAMES',
+                        help="profile the first FRAMES frames of the loop (F9 profiles the next frames later)")
+    parser.add_argument('--trace', metavar='FILE',
+                        help="write a Chrome/Perfetto trace of frames, phases and physics steps (T starts and stops one later)")
+    parser.add_argument('--histograms', metavar='FILE',
+                        help="write the frame, step and render time percentiles as JSON on exit and with H")
+    parser.add_argument('--memory-report', type=float, metavar='SECONDS',
+                        help="print the memory used by each component every SECONDS (M prints one)")
+    parser.add_argument('--memory-growth', action='store_true',
+                        help="track allocations with tracemalloc for the whole run and show their growth in every memory report (slow)")
+    parser.add_argument('--no-governor', action='store_true',
+                        help="keep the full drawing quality even when frames take too long (toggle with Q)")
+    parser.add_argument('--dirty-rects', action='store_true',
+                        help="push only the changed parts of the screen to the display (toggle with D)")
+    parser.add_argument('--static-background', action='store_true',
+                        help="keep the background still, so dirty rects also pay off while running")
+    parser.add_argument('--trail-fade-interval', type=int, default=trail_fade_interval,
+                        help="frames between fades of the 'fade' trail layer (longer trails)")
+    args, _ = parser.parse_known_args(argv)  # The web build may pass extra arguments
+    return args
 
 
-asyncio.run(main())
+if __name__ == "__main__":
+    args = parse_args()
+    set_precision(args.precision)
+    if args.diagnostics:
+        toggle_diagnostics()
+    trail_mode = args.trail_mode
+    trail_fade_buckets = max(1, args.trail_buckets)
+    trail_antialias = args.trail_aa
+    trail_fade_interval = max(1, args.trail_fade_interval)
+    body_glow = args.glow
+    if args.profile:
+        profile_at_start = args.profile
+    histogram_path = args.histograms
+    memory_report_interval = args.memory_report or 0
+    memory_growth_at_start = args.memory_growth
+    if args.trace:
+        start_trace(args.trace)
+    if args.perf_hud:
+        toggle_perf_hud()
+    if args.no_governor:
+        toggle_quality_governor()
+    if args.dirty_rects:
+        dirty_rects.toggle()
+    background_scroll = not args.static_background
+    if args.no_trail_lod:
+        trail_lod = False
+        trails = make_trails(len(bodies))
+    asyncio.run(main())